@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import time
+
+from blobstore import BlobStore
+from catalog import Catalog
+from configuration import Options
+from dirlisting import DirectoryListing
+from messageindex import MessageIndex
+from metrics import Metrics
+from packstore import PackStore
+from pdfqueue import PdfQueue
+from syncstate import SyncState
+
+
+class Archive:
+    """The local archive folder and the state kept next to the messages"""
+
+    def __init__(self, options: Options):
+        self.local_folder = options.local_folder
+        self.metrics = Metrics(options.metrics_file)
+        self.sync_state = SyncState(options.local_folder) if options.incremental else None
+        self.pdf_queue = PdfQueue(options.local_folder, options.wkhtmltopdf, options.pdf_workers, self.metrics) if options.wkhtmltopdf and options.storage != 'packed' else None
+        self.message_index = MessageIndex(options.local_folder) if options.message_index else None
+        self.pack_store = PackStore(options.local_folder, options.pack_compression, options.pack_segment_size, options.pack_sync_interval, self.message_index) if options.storage == 'packed' else None
+        self.catalog = Catalog(options.local_folder) if options.catalog else None
+        self.blob_store = BlobStore(os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'blobs')), options.attachment_store) if options.attachment_store else None
+        self.listing = DirectoryListing()
+        self.spool_directory = os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'spool'))
+        # new message directories are written there, then moved into the archive
+        self.staging_directory = os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'staging'))
+        self.clean(self.spool_directory)
+        self.clean(self.staging_directory)
+
+    def clean(self, directory):
+        """Remove the messages spooled or staged by interrupted runs"""
+        if not os.path.isdir(directory):
+            return
+        for entry in os.scandir(directory):
+            if entry.stat().st_mtime < time.time() - 24 * 3600:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def close(self):
+        if self.pdf_queue is not None:
+            self.pdf_queue.join()
+        if self.pack_store is not None:
+            self.pack_store.close()
+        if self.message_index is not None:
+            self.message_index.close()
+        if self.catalog is not None:
+            self.catalog.close()
+        try:
+            self.metrics.write()
+        except OSError as e:
+            print("Couldn't write the metrics file: {}".format(e))
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asyncimap import AsyncIMAP4, quote
+from bodystructure import parse_bodystructure_response
+from configuration import Account, Options
+from connectionpool import ConnectionPool
+from mailboxclient import FolderExport, HEADER_ITEMS, STATUS_BATCH_SIZE, chunks, get_status_items, parse_fetch_response, parse_status_response
+from pipeline import Pipeline
+
+
+async def connect(account: Account):
+    """An authenticated session of the account, without compression whatever account.compress"""
+    mailbox = await AsyncIMAP4.open(account.host, int(account.port), account.ssl)
+    try:
+        await mailbox.login(account.username, account.password)
+    except Exception:
+        await mailbox.logout()
+        raise
+    return mailbox
+
+
+async def get_folder_status(mailbox, folders):
+    """{folder: {item: value}} of the folders, from STATUS commands pipelined over one session"""
+    items = get_status_items(mailbox.capabilities)
+    result = {}
+    for batch in chunks(folders, STATUS_BATCH_SIZE):
+        responses = await mailbox.pipeline([('STATUS', (quote(folder), '({})'.format(' '.join(items)))) for folder in batch], 'STATUS')
+        for folder, (typ, data) in zip(batch, responses):
+            status = parse_status_response(data[-1]) if typ == 'OK' and data else None
+            if status:
+                result[folder] = status
+    return result
+
+
+class AsyncConnectionPool(ConnectionPool):
+    """The ConnectionPool of AsyncIMAP4 sessions, on one event loop"""
+
+    def __init__(self, connections_per_host):
+        super().__init__(connections_per_host)
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, account: Account):
+        while True:
+            async with self.condition:
+                mailbox, victim = await self.condition.wait_for(lambda: self.take(account))
+
+            if victim is not None:
+                await victim.logout()
+
+            if mailbox is None:
+                try:
+                    return await connect(account)
+                except Exception:
+                    await self.discard(account)
+                    raise
+
+            try:
+                await mailbox.command('NOOP')
+                return mailbox
+            except Exception:
+                await self.discard(account)
+
+    async def release(self, account: Account, mailbox):
+        try:
+            await mailbox.close()
+        except Exception:
+            await self.discard(account, mailbox)
+            return
+        async with self.condition:
+            self.put(account, mailbox)
+
+    async def discard(self, account: Account, mailbox=None):
+        if mailbox is not None:
+            await mailbox.logout()
+        async with self.condition:
+            self.drop(account)
+
+    async def close_all(self):
+        async with self.condition:
+            idle = self.take_all()
+        for mailbox in idle:
+            await mailbox.logout()
+
+
+class AsyncMailboxClient(FolderExport):
+    """The export of a folder over an AsyncIMAP4 session, the work on files done on executor
+
+    The messages of a fetch are saved while the next ones are fetched.
+    """
+
+    def __init__(self, account: Account, options: Options, archive, mailbox: AsyncIMAP4, executor):
+        super().__init__(account, options, archive)
+        self.mailbox = mailbox
+        self.executor = executor
+        self.mailbox.spool_size = options.spool_size
+        self.mailbox.spool_directory = self.spool_directory
+        self.message_count = 0
+
+    async def select(self):
+        with self.metrics.timer(self.metrics_key, 'select'):
+            for name in self.get_select_names():
+                typ, data = await self.mailbox.select(name)
+                if typ == 'OK':
+                    break
+        if typ != 'OK':
+            raise AsyncIMAP4.error("Could not select remote folder '%s'" % self.account.remote_folder)
+        print(f"{data} messages found.")
+        self.message_count = int(data[-1]) if data and data[-1] else 0
+        self.uidvalidity = self.get_uidvalidity()
+
+    async def run(self, function, *args):
+        """The result of function, called on the executor"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def search_uids(self, last_uid):
+        with self.metrics.timer(self.metrics_key, 'search'):
+            typ, data = await self.mailbox.uid('SEARCH', self.get_search_criterion(last_uid))
+        # "UID n:*" always matches the last message, even if its UID is lower than n
+        return [uid for uid in map(int, data[0].split()) if uid > last_uid]
+
+    async def copy_mails(self, process_pool=None):
+        last_uid = self.get_last_uid()
+
+        uids = await self.search_uids(last_uid)
+        fetched = set()
+        results = {}
+        pipeline = Pipeline(process_pool, self.options, self.options.local_folder, self.archive, self.metrics_key) if process_pool else None
+
+        checkpoint = 0
+        saving = None
+        try:
+            for start in range(0, len(uids), self.header_batch_size):
+                batch = uids[start:start + self.header_batch_size]
+                missing = await self.get_missing_uids(batch)
+                fetched.update(missing)
+                async for messages in self.fetch_missing(missing):
+                    if saving is not None:
+                        await saving
+                    saving = asyncio.ensure_future(self.run(self.save_mails, messages, results, pipeline))
+                if saving is not None:
+                    await saving
+                    saving = None
+                end = start + len(batch)
+                if end < len(uids):
+                    checkpoint = await self.run(self.save_progress, uids, checkpoint, end, fetched,
+                                                pipeline.results if pipeline is not None else results, pipeline is None)
+        finally:
+            if saving is not None:
+                await saving
+            if pipeline is not None:
+                results = await self.run(pipeline.join)
+
+        return await self.run(self.count_results, uids, fetched, results, last_uid)
+
+    def save_mails(self, messages, results, pipeline=None):
+        """Save the fetched (uid, raw) messages, runs on the executor"""
+        for uid, raw in messages:
+            if pipeline is not None:
+                pipeline.submit(uid, raw, uid in self.partial_uids)
+            else:
+                results[uid] = self.save_mail(raw, uid in self.partial_uids)
+
+    async def get_missing_uids(self, uids):
+        """Fetch only the headers of the given messages and return {uid: size} of those not yet archived"""
+        with self.metrics.timer(self.metrics_key, 'headers'):
+            typ, data = await self.mailbox.uid('FETCH', ','.join(map(str, uids)), HEADER_ITEMS)
+        if typ != 'OK':
+            return dict.fromkeys(uids)
+        # looks the messages up on disk and in the message index
+        return await self.run(self.select_missing, uids, parse_fetch_response(data))
+
+    async def fetch_missing(self, missing):
+        """Fetch the messages of {uid: size} and yield the [(uid, raw)] of each fetch"""
+        batches, large = self.split_missing(missing)
+        for fetch_uids in batches:
+            yield await self.fetch_mails(fetch_uids)
+        if large:
+            async for messages in self.fetch_partial_mails(large):
+                yield messages
+
+    async def fetch_mails(self, uids):
+        """Fetch the full messages of a batch with a single command, return [(uid, raw)]"""
+        with self.metrics.timer(self.metrics_key, 'fetch'):
+            typ, data = await self.mailbox.uid('FETCH', ','.join(map(str, uids)), '(RFC822)')
+        if typ != 'OK':
+            print("AsyncMailboxClient: Could not fetch messages %s" % uids)
+            return [(uid, None) for uid in uids]
+        return self.read_messages(parse_fetch_response(data))
+
+    async def fetch_partial_mails(self, uids):
+        """Fetch the messages without their parts above max_attachment_size, see MailboxClient.fetch_partial_mails"""
+        max_size = self.account.max_attachment_size
+        structures = {}
+        for batch in chunks(uids, self.options.fetch_batch_size):
+            with self.metrics.timer(self.metrics_key, 'headers'):
+                typ, data = await self.mailbox.uid('FETCH', ','.join(map(str, batch)), '(BODYSTRUCTURE)')
+            if typ == 'OK':
+                structures.update(parse_bodystructure_response(data))
+        batches, partial = self.split_partial(uids, structures)
+        for fetch_uids in batches:
+            yield await self.fetch_mails(fetch_uids)
+
+        for uid in partial:
+            structure = structures[uid]
+            with self.metrics.timer(self.metrics_key, 'fetch'):
+                typ, data = await self.mailbox.uid('FETCH', str(uid), '({})'.format(' '.join(structure.fetch_items(max_size))))
+            if typ != 'OK':
+                print("AsyncMailboxClient: Could not fetch message %s" % uid)
+                yield [(uid, None)]
+                continue
+            # the parts are joined, and spooled if large, on the executor
+            yield await self.run(self.read_partial, uid, structure, parse_fetch_response(data))
+
+
+class AsyncExporter:
+    """Export all the folders of all the accounts on one event loop
+
+    A folder is exported as soon as a session of its host is free, at most
+    connections_per_host at once per host. The messages are parsed and written on a
+    pool of workers threads, or on the processes of the pipeline.
+    """
+
+    def __init__(self, exporter, options: Options, archive, process_pool=None):
+        self.exporter = exporter
+        self.options = options
+        self.archive = archive
+        self.process_pool = process_pool
+        self.pool = None
+
+    def run(self):
+        asyncio.run(self.export())
+
+    async def export(self):
+        compressed = [account.name for account in self.options.accounts if account.compress]
+        if compressed:
+            print('The asyncio engine does not compress the IMAP traffic, compress is ignored for {}'.format(', '.join(compressed)))
+        self.pool = AsyncConnectionPool(self.options.connections_per_host)
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.options.workers)) as executor:
+                folder_lists = await asyncio.gather(*[self.get_folders(account) for account in self.options.accounts])
+                await asyncio.gather(*[
+                    self.safe_mails(account, folder_options, executor)
+                    for account, folder_options in [job for jobs in folder_lists for job in jobs]
+                ])
+        finally:
+            await self.pool.close_all()
+
+    async def get_folders(self, account: Account):
+        """(account, options) of the folders to export, see Exporter.get_folders"""
+        print('{}/{} (on {})'.format(account.name, account.remote_folder, account.host))
+
+        if account.remote_folder != "__ALL__":
+            return [(account, self.options)]
+
+        try:
+            mailbox = await self.pool.acquire(account)
+        except Exception as e:
+            print("Couldn't connect to {}: {}".format(account.host, e))
+            return []
+        try:
+            folder_names = Account.parse_folder_list((await mailbox.list())[1])
+        except Exception as e:
+            await self.pool.discard(account, mailbox)
+            print("Couldn't list folders of {}: {}".format(account.name, e))
+            return []
+        statuses = {}
+        if self.archive.sync_state is not None:
+            try:
+                statuses = await get_folder_status(mailbox, folder_names)
+            except Exception as e:
+                print("Couldn't get the status of the folders of {}: {}".format(account.name, e))
+                await self.pool.discard(account, mailbox)
+                mailbox = None
+        if mailbox is not None:
+            await self.pool.release(account, mailbox)
+        return self.exporter.select_folders(account, self.options, folder_names, statuses, self.archive)
+
+    async def safe_mails(self, account: Account, options: Options, executor):
+        key = (account.name, account.remote_folder)
+        start = time.perf_counter()
+        try:
+            with self.archive.metrics.timer(key, 'connect'):
+                mailbox = await self.pool.acquire(account)
+        except Exception as e:
+            print("Couldn't connect to {}: {}".format(account.host, e))
+            return
+        print("Saving folder: {}/{}".format(account.name, account.remote_folder))
+        try:
+            mailbox_client = AsyncMailboxClient(account, options, self.archive, mailbox, executor)
+            try:
+                await mailbox_client.select()
+                stats = await mailbox_client.copy_mails(self.process_pool)
+            finally:
+                self.archive.metrics.add_duration(key, time.perf_counter() - start)
+        except Exception as e:
+            print("Exporter: saving {}/{} failed".format(account.name, account.remote_folder))
+            print(e)
+            await self.pool.discard(account, mailbox)
+            return
+        await self.pool.release(account, mailbox)
+        print('{}/{}: {} emails created, {} emails already exists, in {:.1f}s'.format(account.name, account.remote_folder, stats[0], stats[1], time.perf_counter() - start))
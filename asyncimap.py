@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import re
+import ssl
+
+from spool import CHUNK_SIZE, SpooledLiteral, create_spool_path
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+UNTAGGED_RE = re.compile(rb'\* (?:(\d+) )?([A-Za-z-]+) ?(.*)$', re.S)
+RESPONSE_CODE_RE = re.compile(rb'^\[([A-Za-z-]+) ?([^\]]*)\]')
+TAGGED_RE = re.compile(rb'^(\S+) (OK|NO|BAD)\b ?(.*)$', re.I | re.S)
+
+# longest response line, the literals are read apart
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+def quote(value):
+    """An IMAP quoted string"""
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class AsyncIMAP4:
+    """A small IMAP4rev1 client on asyncio streams, for many sessions on one event loop
+
+    The commands of a session are sent one after the other and return (typ, data), data
+    being the untagged responses of the command in the shape imaplib gives them, so the
+    parsers written for imaplib apply. Literals of spool_size bytes or more are written
+    into spool_directory as SpooledLiteral, like with SpoolingIMAP4, the file operations
+    on the default executor of the loop.
+    """
+
+    class error(Exception):
+        pass
+
+    class abort(error):
+        pass
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tag_number = 0
+        self.lock = asyncio.Lock()
+        self.selected = False
+        self.capabilities = ()
+        # of the last command, by name
+        self.untagged_responses = {}
+        self.spool_size = 0
+        self.spool_directory = None
+
+    @classmethod
+    async def open(cls, host, port, use_ssl=False):
+        # the context of imaplib.IMAP4_SSL, so the servers of the threads engine are accepted as well
+        context = ssl._create_stdlib_context() if use_ssl else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=context, limit=LINE_LIMIT)
+        mailbox = cls(reader, writer)
+        pieces = await mailbox.read_response()
+        if not pieces[0].startswith(b'* OK') and not pieces[0].startswith(b'* PREAUTH'):
+            writer.close()
+            raise cls.error('unexpected greeting: {!r}'.format(pieces[0]))
+        typ, data = await mailbox.command('CAPABILITY')
+        if typ == 'OK' and data and data[-1]:
+            mailbox.capabilities = tuple(data[-1].decode().upper().split())
+        return mailbox
+
+    async def read_line(self):
+        line = await self.reader.readline()
+        if not line:
+            raise self.abort('connection closed')
+        return line[:-2] if line.endswith(b'\r\n') else line.rstrip(b'\n')
+
+    async def read_literal(self, size):
+        if not self.spool_size or not self.spool_directory or size < self.spool_size:
+            return await self.reader.readexactly(size)
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, create_spool_path, self.spool_directory)
+        fp = await loop.run_in_executor(None, open, path, 'wb')
+        try:
+            remaining = size
+            while remaining:
+                chunk = await self.reader.readexactly(min(remaining, CHUNK_SIZE))
+                await loop.run_in_executor(None, fp.write, chunk)
+                remaining -= len(chunk)
+        finally:
+            await loop.run_in_executor(None, fp.close)
+        return SpooledLiteral(path, size)
+
+    async def read_response(self):
+        """A response with its literals, as imaplib splits it: [(text, literal), ..., text]"""
+        pieces = []
+        while True:
+            line = await self.read_line()
+            m = LITERAL_RE.search(line)
+            if m is None:
+                pieces.append(line)
+                return pieces
+            pieces.append((line, await self.read_literal(int(m.group(1)))))
+
+    def add_untagged(self, pieces):
+        first = pieces[0][0] if isinstance(pieces[0], tuple) else pieces[0]
+        m = UNTAGGED_RE.match(first)
+        if m is None:
+            return
+        number, name, rest = m.groups()
+        name = name.decode().upper()
+        if name == 'BYE':
+            raise self.abort(rest.decode('utf8', 'replace'))
+        data = number + (b' ' + rest if rest else b'') if number else rest
+        pieces[0] = (data, pieces[0][1]) if isinstance(pieces[0], tuple) else data
+        self.untagged_responses.setdefault(name, []).extend(pieces)
+        code = RESPONSE_CODE_RE.match(rest) if name in ('OK', 'NO', 'BAD') else None
+        if code:
+            self.untagged_responses.setdefault(code.group(1).decode().upper(), []).append(code.group(2))
+
+    async def send(self, *words):
+        self.tag_number += 1
+        tag = 'A{:04d}'.format(self.tag_number)
+        self.writer.write('{} {}\r\n'.format(tag, ' '.join(words)).encode('utf8'))
+        await self.writer.drain()
+        return tag
+
+    async def complete(self, tag):
+        """Read the responses up to the tagged one of tag, return its (typ, text)"""
+        while True:
+            pieces = await self.read_response()
+            first = pieces[0][0] if isinstance(pieces[0], tuple) else pieces[0]
+            if first.startswith(b'* '):
+                self.add_untagged(pieces)
+                continue
+            m = TAGGED_RE.match(first)
+            if m is not None and m.group(1).decode() == tag:
+                return m.group(2).decode().upper(), m.group(3)
+
+    async def command(self, name, *args, response=None):
+        """Send a command and return (typ, data), data being its untagged responses named response"""
+        async with self.lock:
+            self.untagged_responses = {}
+            typ, text = await self.complete(await self.send(name, *args))
+        if typ == 'BAD':
+            raise self.error('{} command error: {} {!r}'.format(name, typ, text))
+        return typ, self.untagged_responses.get(response or name, [None])
+
+    async def pipeline(self, commands, response):
+        """Send all the (name, args) commands, then return the (typ, data) of each"""
+        results = []
+        async with self.lock:
+            tags = [await self.send(name, *args) for name, args in commands]
+            for tag in tags:
+                self.untagged_responses = {}
+                typ, text = await self.complete(tag)
+                results.append((typ, self.untagged_responses.get(response, [])))
+        return results
+
+    def response(self, name):
+        """The untagged responses of the last command named name, like imaplib"""
+        return name, self.untagged_responses.get(name, [None])
+
+    async def login(self, user, password):
+        typ, data = await self.command('LOGIN', quote(user), quote(password))
+        if typ != 'OK':
+            raise self.error('LOGIN failed')
+        return typ, data
+
+    async def list(self):
+        return await self.command('LIST', '""', '*')
+
+    async def select(self, mailbox, readonly=True):
+        typ, data = await self.command('EXAMINE' if readonly else 'SELECT', quote(mailbox), response='EXISTS')
+        self.selected = typ == 'OK'
+        return typ, data
+
+    async def uid(self, command, *args):
+        return await self.command('UID', command, *args, response=command.upper())
+
+    async def fetch(self, message_set, items):
+        return await self.command('FETCH', message_set, items)
+
+    async def close(self):
+        if self.selected:
+            self.selected = False
+            return await self.command('CLOSE')
+        return 'OK', []
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        except (self.error, OSError):
+            pass
+        finally:
+            self.writer.close()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure the export throughput of imapbox against a local IMAP stand-in server
+
+A synthetic corpus is generated from a seed and served by imapstandin.py in a separate
+process, so the peak memory reported is the one of the export alone. Nothing leaves the
+machine, the archive is written to a temporary folder.
+
+    python benchmark.py --messages 2000 --folders 4 -o workers=4 -o processes=2
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import email.policy
+import email.utils
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+
+import mailboxclient
+from imapstandin import StandInMailbox, StandInServer
+
+WORDS = {
+    'us-ascii': 'the mail archive message folder server account report meeting invoice please thanks regards '
+                'attached review tomorrow project update schedule budget question answer'.split(),
+    'utf-8': 'naïve café Grüße καλημέρα привет 日本語 emoji ✉ ☃ résumé smörgåsbord'.split(),
+    'iso-8859-1': 'café über naïve façade señor Grüße déjà à côté garçon'.split(),
+    'windows-1252': 'café €100 “quoted” naïve œuvre – dash Grüße'.split(),
+    'koi8-r': 'привет письмо архив сообщение папка сервер отчёт встреча'.split(),
+    'shift_jis': '日本語 メール 添付 ファイル 会議 報告 よろしく お願いします'.split(),
+}
+
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                    '1f15c4890000000d49444154789c63000100000500010d0a2db40000000049454e44ae426082')
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little') if size > 0 else b''
+
+
+def make_text(rng, charset, size):
+    words = WORDS['us-ascii'] + WORDS.get(charset, [])
+    lines = [' '.join(rng.choice(words) for _ in range(10)) for _ in range(64)]
+    text = []
+    length = 0
+    while length < size:
+        line = rng.choice(lines)
+        text.append(line)
+        length += len(line) + 1
+    return '\n'.join(text) + '\n'
+
+
+def make_message(rng, args, number, charsets, today):
+    """A raw message of about a random size drawn from the corpus size distribution"""
+    size = min(int(rng.lognormvariate(math.log(args.size), args.size_sigma)), args.max_size)
+    charset = rng.choice(charsets)
+    with_attachment = rng.random() < args.attachments
+    with_image = rng.random() < args.inline_images
+    date = today - rng.uniform(0, 30 * 24 * 3600)
+
+    message = EmailMessage()
+    message['From'] = 'Sender {} <sender{}@example.com>'.format(number % 97, number % 97)
+    message['To'] = 'Recipient <recipient@example.com>'
+    if rng.random() < 0.3:
+        message['Cc'] = 'Someone <someone@example.com>, Other <other@example.com>'
+    message['Subject'] = make_text(rng, charset, 40).splitlines()[0]
+    message['Date'] = email.utils.formatdate(date, localtime=True)
+    message['Message-Id'] = '<benchmark.{}.{}@imapbox.invalid>'.format(args.seed, number)
+
+    # base64 bodies are a third larger than the attachment
+    attachment_size = int(size * 0.75 * 0.7) if with_attachment else 0
+    text = make_text(rng, charset, size - attachment_size * 4 // 3)
+    message.set_content(text, charset=charset)
+    if with_image:
+        html = '<html><body><p>{}</p><img src="cid:image{}@imapbox.invalid"></body></html>'.format(
+            '</p><p>'.join(text.splitlines()[:20]), number)
+        message.add_alternative(html, subtype='html', charset=charset)
+        message.get_payload()[1].add_related(PNG, 'image', 'png', cid='<image{}@imapbox.invalid>'.format(number),
+                                             filename='image{}.png'.format(number))
+    if with_attachment:
+        message.add_attachment(random_bytes(rng, attachment_size), maintype='application', subtype='octet-stream',
+                               filename='attachment{}.bin'.format(number))
+    for i, part in enumerate(message.walk()):
+        if part.is_multipart():
+            # instead of random boundaries
+            part.set_boundary('=_benchmark.{}.{}'.format(number, i))
+    return message.as_bytes(policy=email.policy.SMTP)
+
+
+def generate_corpus(args):
+    """Return {folder: [raw message]}, the same for the same arguments on the same day"""
+    rng = random.Random(args.seed)
+    # the messages are from the last 30 days, so the days option keeps its meaning
+    today = time.time() // (24 * 3600) * (24 * 3600)
+    charsets = args.charsets.split(',')
+    folders = ['INBOX'] + ['Folder{}'.format(i) for i in range(1, args.folders)]
+    corpus = {folder: [] for folder in folders}
+    generated = []
+    for number in range(args.messages):
+        folder = folders[number % len(folders)]
+        if generated and rng.random() < args.duplicates:
+            # the same message in another folder
+            corpus[folder].append(rng.choice(generated))
+            continue
+        raw = make_message(rng, args, number, charsets, today)
+        generated.append(raw)
+        corpus[folder].append(raw)
+    return corpus
+
+
+def serve(args, connection):
+    """Run the stand-in server in its own process, answer 'stats' requests until None"""
+    mailboxes = {}
+    for folder, messages in generate_corpus(args).items():
+        mailbox = StandInMailbox(folder)
+        for raw in messages:
+            mailbox.append(raw)
+        mailboxes[folder] = mailbox
+    server = StandInServer(mailboxes)
+    port = server.start()
+    connection.send((port, sum(len(m.messages) for m in mailboxes.values()), sum(len(message.raw) for m in mailboxes.values() for message in m.messages)))
+    while connection.recv() is not None:
+        connection.send((server.commands, server.bytes_sent))
+    server.shutdown()
+
+
+def peak_rss(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def write_config(local_folder, port, options, compress=True):
+    """The config read last by imapbox, so it wins over the config files of the user"""
+    with open(os.path.join(local_folder, 'config.cfg'), 'w', encoding='utf8') as fp:
+        fp.write('[imapbox]\n')
+        settings = {'days': '0', 'wkhtmltopdf': ''}
+        settings.update(options)
+        # the stage timings are read from the metrics of imapbox
+        settings['metrics_file'] = metrics_file(local_folder)
+        for name, value in settings.items():
+            fp.write('{}={}\n'.format(name, value))
+        fp.write('\n[benchmark]\nhost=127.0.0.1\nport={}\nusername=benchmark\npassword=benchmark\nssl=False\ncompress={}\nremote_folder=__ALL__\n'.format(port, compress))
+
+
+def metrics_file(local_folder):
+    return os.path.join(local_folder, '.imapbox', 'benchmark-metrics.json')
+
+
+def sum_metrics(report, name):
+    """Sum the stages or counters of the metrics report over the folders"""
+    total = dict(report[name])
+    for folder in report['folders']:
+        for key, value in folder[name].items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def run_export(local_folder, server, verbose):
+    """Run the imapbox exporter once and return its measures"""
+    server.send('stats')
+    commands, bytes_sent = server.recv()
+    cpu = cpu_time(resource.RUSAGE_SELF)
+    argv = sys.argv
+    sys.argv = ['imapbox.py', '-l', local_folder, '-a', 'benchmark']
+    os.environ['IMAPBOX_LOCAL_FOLDER'] = local_folder
+    start = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            mailboxclient.Exporter().run()
+    finally:
+        sys.argv = argv
+    elapsed = time.perf_counter() - start
+    server.send('stats')
+    end_commands, end_bytes_sent = server.recv()
+    with open(metrics_file(local_folder), 'r', encoding='utf8') as fp:
+        report = json.load(fp)
+    return {
+        'seconds': elapsed,
+        'cpu_seconds': cpu_time(resource.RUSAGE_SELF) - cpu,
+        'round_trips': end_commands - commands,
+        'bytes': end_bytes_sent - bytes_sent,
+        'stages': sum_metrics(report, 'stages'),
+        'counters': sum_metrics(report, 'counters'),
+        'peak_rss': peak_rss(resource.RUSAGE_SELF),
+        'peak_rss_children': peak_rss(resource.RUSAGE_CHILDREN),
+    }
+
+
+def print_run(name, run, messages):
+    print('{}: {:.2f} s, {:.1f} messages/s, {:.2f} MB sent at {:.2f} MB/s, {} round-trips, {} created, cpu {:.2f} s, peak RSS {:.1f} MB (workers {:.1f} MB)'.format(
+        name, run['seconds'], messages / run['seconds'], run['bytes'] / 1024 / 1024, run['bytes'] / run['seconds'] / 1024 / 1024, run['round_trips'],
+        run['counters'].get('messages_created', 0), run['cpu_seconds'], run['peak_rss'] / 1024 / 1024, run['peak_rss_children'] / 1024 / 1024))
+    for stage, seconds in sorted(run['stages'].items(), key=lambda item: -item[1]):
+        print('    {:<24} {:8.3f} s'.format(stage, seconds))
+    print('    ' + ', '.join('{} {}'.format(name, value) for name, value in sorted(run['counters'].items())))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark imapbox against a local IMAP stand-in server")
+    argparser.add_argument('--messages', type=int, default=1000, help="Number of messages of the corpus")
+    argparser.add_argument('--folders', type=int, default=1, help="Number of folders, the messages are spread over them")
+    argparser.add_argument('--size', type=int, default=20000, help="Median size of the messages in bytes")
+    argparser.add_argument('--size-sigma', type=float, default=1.0, help="Spread of the log-normal size distribution")
+    argparser.add_argument('--max-size', type=int, default=20 * 1024 * 1024, help="Maximum size of a message in bytes")
+    argparser.add_argument('--attachments', type=float, default=0.3, help="Fraction of messages with an attachment")
+    argparser.add_argument('--inline-images', type=float, default=0.2, help="Fraction of messages with an HTML part and an inline image")
+    argparser.add_argument('--charsets', default=','.join(WORDS), help="Comma separated charsets of the text parts")
+    argparser.add_argument('--duplicates', type=float, default=0.0, help="Fraction of messages copied into another folder")
+    argparser.add_argument('--seed', type=int, default=1, help="Seed of the corpus generator")
+    argparser.add_argument('-o', dest='options', action='append', default=[], metavar='NAME=VALUE',
+                           help="imapbox option of the [imapbox] config section, e.g. -o workers=4")
+    argparser.add_argument('--no-compress', dest='compress', action='store_false', help="Don't negotiate COMPRESS=DEFLATE with the stand-in server")
+    argparser.add_argument('--repeat', type=int, default=1, help="Export again into the same archive, to measure runs without new messages")
+    argparser.add_argument('--keep', action='store_true', help="Keep the archive folder")
+    argparser.add_argument('--json', dest='json_file', help="Write the results to this JSON file")
+    argparser.add_argument('-v', dest='verbose', action='store_true', help="Show the output of imapbox")
+    args = argparser.parse_args()
+
+    options = dict(option.split('=', 1) for option in args.options)
+    print('Generating {} messages...'.format(args.messages))
+    server, child = multiprocessing.get_context('spawn').Pipe()
+    process = multiprocessing.get_context('spawn').Process(target=serve, args=(args, child), daemon=True)
+    process.start()
+    port, messages, corpus_bytes = server.recv()
+    print('{} messages, {:.1f} MB served on port {}'.format(messages, corpus_bytes / 1024 / 1024, port))
+
+    local_folder = tempfile.mkdtemp(prefix='imapbox-benchmark-')
+    write_config(local_folder, port, options, args.compress)
+    runs = []
+    try:
+        for number in range(max(1, args.repeat)):
+            run = run_export(local_folder, server, args.verbose)
+            runs.append(run)
+            print_run('run {}'.format(number + 1), run, messages)
+    finally:
+        server.send(None)
+        process.join(5)
+        if args.keep:
+            print('archive kept in {}'.format(local_folder))
+        else:
+            shutil.rmtree(local_folder, ignore_errors=True)
+
+    if args.json_file:
+        corpus = {name: value for name, value in vars(args).items() if name not in ('options', 'compress', 'keep', 'json_file', 'verbose')}
+        with open(args.json_file, 'w', encoding='utf8') as fp:
+            json.dump({'corpus': corpus, 'messages': messages, 'corpus_bytes': corpus_bytes, 'options': options, 'compress': args.compress, 'runs': runs}, fp, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class HashingWriter:
+    """File-like sink computing the SHA-256 of what is written"""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return len(data)
+
+
+class BlobStore:
+    """Content-addressed store of attachments, each unique content is written once
+
+    mode 'hardlink' links the blobs into the attachments folder of each message,
+    mode 'reference' only records the blob hashes in message.json.
+    """
+
+    def __init__(self, directory, mode='hardlink'):
+        self.directory = directory
+        self.mode = mode
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def blob(self, content):
+        """Wrap the content of an attachment (bytes or spooled content) into a Blob"""
+        if isinstance(content, (bytes, bytearray)):
+            digest = hashlib.sha256(content).hexdigest()
+        else:
+            writer = HashingWriter()
+            content.write_to(writer)
+            digest = writer.digest.hexdigest()
+        return Blob(self, content, digest)
+
+    def put(self, blob):
+        path = self.path(blob.digest)
+        if os.path.exists(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            if isinstance(blob.content, (bytes, bytearray)):
+                fp.write(blob.content)
+            else:
+                blob.content.write_to(fp)
+        # mkstemp creates private files, use the permissions of a regular file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+        return path
+
+    def link(self, blob, target):
+        path = self.put(blob)
+        if self.mode != 'hardlink':
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # linked under a temporary name and moved over target: the last attachment of a name wins, like a plain write
+        tmp_path = target + '.tmp'
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            # no hardlinks on this filesystem
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+        if os.path.lexists(tmp_path):
+            # target was already a link to the same blob, rename() leaves both names
+            os.remove(tmp_path)
+
+
+class Blob:
+    """An attachment stored in a BlobStore"""
+
+    def __init__(self, store, content, digest):
+        self.store = store
+        self.content = content
+        self.digest = digest
+
+    def save(self, path):
+        self.store.link(self, path)
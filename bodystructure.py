@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import email.parser
+import io
+import itertools
+import os
+import re
+import tempfile
+
+from spool import SpooledLiteral
+
+FETCH_START_RE = re.compile(rb'^\d+ \(')
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+MARKER_RE = re.compile(rb'^X-Imapbox-(?:Omitted|Partial):.*\r?\n', re.I | re.M)
+
+# a message assembled from some of its parts, the parts left on the server have an empty body
+PARTIAL_HEADER = 'X-Imapbox-Partial'
+OMITTED_HEADER = 'X-Imapbox-Omitted'
+# empty file next to the message.eml of these messages, a sender can write these headers too
+PARTIAL_FILE = 'message.partial'
+
+
+def tokenize(pieces):
+    """Tokens of a response given as imaplib returns it, text lines and (text, literal) tuples"""
+    for piece in pieces:
+        text, literal = piece if isinstance(piece, tuple) else (piece, None)
+        if literal is not None:
+            text = text[:LITERAL_RE.search(text).start()]
+        for m in TOKEN_RE.finditer(text):
+            if m.group(1):
+                yield '('
+            elif m.group(2):
+                yield ')'
+            elif m.group(3) is not None:
+                yield re.sub(rb'\\(.)', rb'\1', m.group(3))
+            elif m.group(4).upper() == b'NIL':
+                yield None
+            elif m.group(4).isdigit():
+                yield int(m.group(4))
+            else:
+                yield m.group(4)
+        if literal is not None:
+            yield literal
+
+
+def parse_list(tokens):
+    """Nested lists of the parenthesized tokens"""
+    stack = [[]]
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def parse_bodystructure_response(data):
+    """{uid: BodyPart} of the messages of a FETCH (UID BODYSTRUCTURE) response"""
+    messages = []
+    for piece in data:
+        meta = piece[0] if isinstance(piece, tuple) else piece
+        if meta is None:
+            continue
+        if FETCH_START_RE.match(meta):
+            messages.append([])
+        if messages:
+            messages[-1].append(piece)
+    result = {}
+    for pieces in messages:
+        items = parse_list(tokenize(pieces))
+        if len(items) < 2 or not isinstance(items[1], list):
+            continue
+        values = dict(zip((name.upper() if isinstance(name, bytes) else name for name in items[1][::2]), items[1][1::2]))
+        if isinstance(values.get(b'UID'), int) and isinstance(values.get(b'BODYSTRUCTURE'), list):
+            result[values[b'UID']] = BodyPart(values[b'BODYSTRUCTURE'])
+    return result
+
+
+def text(value):
+    return value.decode('utf8', 'replace') if isinstance(value, bytes) else ''
+
+
+class BodyPart:
+    """A part of a BODYSTRUCTURE and its section number"""
+
+    def __init__(self, structure, section='', top=True):
+        self.section = section or '1'
+        self.top = top
+        self.children = []
+        self.content_id = None
+        self.size = 0
+        self.disposition = None
+        self.filename = None
+        if structure and isinstance(structure[0], list):
+            self.type = 'multipart'
+            prefix = section + '.' if section else ''
+            # the parts come first, the lists after the subtype are extension data (parameters, disposition)
+            children = list(itertools.takewhile(lambda child: isinstance(child, list), structure))
+            self.children = [BodyPart(child, prefix + str(number), False) for number, child in enumerate(children, 1)]
+            rest = structure[len(children):]
+            self.subtype = text(rest[0]).lower() if rest else 'mixed'
+            return
+
+        fields = structure + [None] * (12 - len(structure))
+        self.type = text(fields[0]).lower()
+        self.subtype = text(fields[1]).lower()
+        params = fields[2] if isinstance(fields[2], list) else []
+        self.filename = self.get_param(params, b'NAME')
+        self.content_id = fields[3]
+        self.size = fields[6] if isinstance(fields[6], int) else 0
+        # the extension data follows the fields specific to text and message/rfc822 parts
+        if self.type == 'text':
+            disposition = fields[9]
+        elif self.type == 'message' and self.subtype == 'rfc822':
+            disposition = fields[11]
+        else:
+            disposition = fields[8]
+        if isinstance(disposition, list) and disposition:
+            self.disposition = text(disposition[0]).lower()
+            params = disposition[1] if len(disposition) > 1 and isinstance(disposition[1], list) else []
+            self.filename = self.get_param(params, b'FILENAME') or self.filename
+
+    @staticmethod
+    def get_param(params, name):
+        for key, value in zip(params[::2], params[1::2]):
+            if isinstance(key, bytes) and key.upper() == name:
+                return text(value)
+        return None
+
+    @property
+    def content_type(self):
+        return '{}/{}'.format(self.type, self.subtype)
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def is_wanted(self, max_size):
+        """True for the bodies, the inline images and the parts of at most max_size bytes"""
+        if self.type == 'text' and self.subtype in ('plain', 'html') and self.disposition != 'attachment':
+            return True
+        if self.type == 'image' and (self.content_id or self.disposition == 'inline'):
+            return True
+        return self.size <= max_size
+
+    def fetch_items(self, max_size):
+        """The FETCH items of the headers of the parts and of the wanted bodies"""
+        items = ['BODY.PEEK[HEADER]']
+        for part in self.walk():
+            if not part.top:
+                items.append('BODY.PEEK[{}.MIME]'.format(part.section))
+            if not part.children and part.is_wanted(max_size):
+                items.append('BODY.PEEK[{}]'.format(part.section))
+        return items
+
+    def omitted(self, max_size):
+        return [part for part in self.walk() if not part.children and not part.is_wanted(max_size)]
+
+    def write(self, fp, sections, max_size, header):
+        """Write the part with its header, its omitted bodies replaced by an OMITTED_HEADER"""
+        header = MARKER_RE.sub(b'', bytes(header))
+        if not self.children and not self.is_wanted(max_size):
+            header = add_header(header, '{}: size={}; section={}'.format(OMITTED_HEADER, self.size, self.section))
+        if self.top:
+            header = add_header(header, '{}: yes'.format(PARTIAL_HEADER))
+        fp.write(header)
+        if not self.children:
+            if self.is_wanted(max_size):
+                content = sections.get('BODY[{}]'.format(self.section), b'')
+                if isinstance(content, SpooledLiteral):
+                    content.write_to(fp)
+                else:
+                    fp.write(content)
+            return
+        boundary = email.parser.BytesHeaderParser().parsebytes(header).get_boundary()
+        boundary = (boundary or 'imapbox-{}'.format(self.section)).encode('ascii', 'replace')
+        for child in self.children:
+            fp.write(b'\r\n--' + boundary + b'\r\n')
+            child.write(fp, sections, max_size, sections.get('BODY[{}.MIME]'.format(child.section), b'\r\n'))
+        fp.write(b'\r\n--' + boundary + b'--\r\n')
+
+    def assemble(self, sections, max_size, spool_directory=None):
+        """The message made of the fetched sections, a SpooledLiteral if one of them is spooled"""
+        spooled = [content for content in sections.values() if isinstance(content, SpooledLiteral)]
+        try:
+            if not spooled or spool_directory is None:
+                fp = io.BytesIO()
+                self.write(fp, sections, max_size, sections.get('HEADER', b'\r\n'))
+                return fp.getvalue()
+            path = os.path.join(tempfile.mkdtemp(dir=spool_directory), 'message.eml')
+            with open(path, 'wb') as fp:
+                self.write(fp, sections, max_size, sections.get('HEADER', b'\r\n'))
+            return SpooledLiteral(path, os.path.getsize(path))
+        finally:
+            for content in spooled:
+                content.remove()
+
+
+def add_header(header, line):
+    """Insert a header line before the blank line ending a header block"""
+    return header.rstrip(b'\r\n') + b'\r\n' + line.encode('utf8') + b'\r\n\r\n' if header.strip() else line.encode('utf8') + b'\r\n\r\n'
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+from bodystructure import PARTIAL_FILE
+from message import Message
+
+# rows inserted per transaction by rebuild()
+REBUILD_BATCH_SIZE = 1000
+
+
+def format_address(address):
+    name, addr = address
+    if name and addr and name != addr:
+        return '{} <{}>'.format(name, addr)
+    return name or addr
+
+
+def catalog_row(directory, metadata):
+    """(messages row, full-text row) of the metadata of a message.json"""
+    sender = format_address(metadata.get('From') or ('', ''))
+    recipients = ', '.join(format_address(address) for address in (metadata.get('To') or []) + (metadata.get('Cc') or []))
+    return (
+        (directory, metadata.get('Id'), metadata.get('Date'), metadata.get('Utc'), sender, metadata.get('Subject')),
+        (metadata.get('Subject') or '', sender, recipients, ' '.join(metadata.get('Attachments') or []), metadata.get('Body') or ''),
+    )
+
+
+class Catalog:
+    """SQLite catalog of the archived messages with a full-text index of their metadata and body"""
+
+    def __init__(self, local_folder):
+        self.local_folder = local_folder
+        self.file = os.path.join(local_folder, '.imapbox', 'catalog.sqlite')
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.file, check_same_thread=False, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, directory TEXT UNIQUE NOT NULL, '
+                                'message_id TEXT, date TEXT, utc TEXT, sender TEXT, subject TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS messages_utc ON messages (utc)')
+        try:
+            self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5(subject, sender, recipients, attachments, body)')
+        except sqlite3.OperationalError:
+            # sqlite built without FTS5
+            self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts4(subject, sender, recipients, attachments, body)')
+        self.connection.commit()
+
+    def add(self, directory, metadata):
+        """Catalog an archived message, from the same metadata as its message.json"""
+        message_row, text_row = catalog_row(os.path.relpath(directory, self.local_folder), metadata)
+        with self.lock, self.connection:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO messages (directory, message_id, date, utc, sender, subject) '
+                                             'VALUES (?, ?, ?, ?, ?, ?)', message_row)
+            if cursor.rowcount:
+                self.connection.execute('INSERT INTO messages_text (rowid, subject, sender, recipients, attachments, body) '
+                                        'VALUES (?, ?, ?, ?, ?, ?)', (cursor.lastrowid,) + text_row)
+
+    def search(self, query, after=None, before=None, limit=50):
+        """Return (utc, sender, subject, directory) of the messages matching a full-text query, newest first
+
+        after and before are dates (YYYY-MM-DD) compared with the UTC date of the messages.
+        """
+        sql = ('SELECT m.utc, m.sender, m.subject, m.directory FROM messages_text JOIN messages m ON m.id = messages_text.rowid '
+               'WHERE messages_text MATCH ?')
+        parameters = [query]
+        if after:
+            sql += ' AND m.utc >= ?'
+            parameters.append(datetime.datetime.strptime(after, '%Y-%m-%d').strftime('%Y%m%dT%H%M%SZ'))
+        if before:
+            sql += ' AND m.utc < ?'
+            parameters.append(datetime.datetime.strptime(before, '%Y-%m-%d').strftime('%Y%m%dT%H%M%SZ'))
+        sql += ' ORDER BY m.utc DESC LIMIT ?'
+        parameters.append(limit)
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return [(utc, sender, subject, os.path.join(self.local_folder, directory)) for utc, sender, subject, directory in rows]
+
+    def rebuild(self, pack_store=None):
+        """Catalog again every message of the archive, from its message.json or else its message.eml"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM messages_text')
+                self.connection.execute('DELETE FROM messages')
+            count = 0
+            batch = []
+            for directory, metadata in (self.walk_packs(pack_store) if pack_store is not None else self.walk()):
+                batch.append(catalog_row(os.path.relpath(directory, self.local_folder), metadata))
+                if len(batch) >= REBUILD_BATCH_SIZE:
+                    count += self.insert(batch)
+                    batch = []
+            count += self.insert(batch)
+        return count
+
+    def insert(self, rows):
+        with self.connection:
+            start = self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+            self.connection.executemany('INSERT INTO messages (id, directory, message_id, date, utc, sender, subject) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        [(start + i + 1,) + message_row for i, (message_row, text_row) in enumerate(rows)])
+            self.connection.executemany('INSERT INTO messages_text (rowid, subject, sender, recipients, attachments, body) VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(start + i + 1,) + text_row for i, (message_row, text_row) in enumerate(rows)])
+        return len(rows)
+
+    def walk(self):
+        """Yield (directory, metadata) of the archived messages"""
+        for root, dirs, files in os.walk(self.local_folder):
+            dirs[:] = [d for d in dirs if d not in ('.imapbox', 'attachments')]
+            if 'message.eml' not in files:
+                continue
+            try:
+                if 'message.json' in files:
+                    with open(os.path.join(root, 'message.json'), 'r', encoding='utf8') as fp:
+                        yield root, json.load(fp)
+                else:
+                    with open(os.path.join(root, 'message.eml'), 'rb') as fp:
+                        yield root, Message(fp.read(), os.path.dirname(root), partial=PARTIAL_FILE in files).metadata
+            except Exception as e:
+                print("Couldn't catalog {}: {}".format(root, e))
+
+    def walk_packs(self, pack_store):
+        """Yield (directory, metadata) of the messages of a PackStore"""
+        for directory in pack_store.directories():
+            try:
+                data = pack_store.read_file(directory, 'message.json')
+                if data is not None:
+                    yield os.path.join(self.local_folder, directory), json.loads(data.decode('utf8'))
+                else:
+                    yield os.path.join(self.local_folder, directory), Message(pack_store.read_file(directory, 'message.eml'), self.local_folder,
+                                                                              partial=pack_store.read_file(directory, PARTIAL_FILE) is not None).metadata
+            except Exception as e:
+                print("Couldn't catalog {}: {}".format(directory, e))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
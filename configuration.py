@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import imaplib
 import getpass
 import os
 
 from six.moves import configparser
 
+from spool import SpoolingIMAP4, SpoolingIMAP4_SSL
+
 
 class Account:
     def __init__(self, name):
@@ -17,23 +18,38 @@ class Account:
         self.username = None
         self.password = None
         self.ssl = False
+        self.compress = True
+        # larger parts of the messages are left on the server, 0 to fetch the full messages
+        self.max_attachment_size = 0
+        # STATUS of the folder before its export, see Exporter.get_folders
+        self.status = None
 
     def get_mailbox(self):
         if not self.ssl:
-            mailbox = imaplib.IMAP4(self.host, self.port)
+            mailbox = SpoolingIMAP4(self.host, self.port)
         else:
-            mailbox = imaplib.IMAP4_SSL(self.host, self.port)
+            mailbox = SpoolingIMAP4_SSL(self.host, self.port)
         mailbox.login(self.username, self.password)
+        if self.compress:
+            mailbox.enable_compression()
         return mailbox
 
-    def get_folder_fist(self):
-        mailbox = self.get_mailbox()
-        folder_list = mailbox.list()[1]
-        try:
-            mailbox.close()
-        except Exception as e:
-            print(e)
-        mailbox.logout()
+    def get_folder_fist(self, mailbox=None):
+        if mailbox is not None:
+            folder_list = mailbox.list()[1]
+        else:
+            mailbox = self.get_mailbox()
+            folder_list = mailbox.list()[1]
+            try:
+                mailbox.close()
+            except Exception as e:
+                print(e)
+            mailbox.logout()
+        return self.parse_folder_list(folder_list)
+
+    @staticmethod
+    def parse_folder_list(folder_list):
+        """Folder names of the data of a LIST response"""
         result = []
         try:
             folder_entry: bytes
@@ -55,13 +71,36 @@ class Options:
         self.days = int(os.getenv('IMAPBOX_DAYS', None)) if os.getenv('IMAPBOX_DAYS') else None
         self.local_folder = os.getenv('IMAPBOX_LOCAL_FOLDER', '.')
         self.wkhtmltopdf = os.getenv('IMAPBOX_WKHTMLTOPDF', None)
+        self.pdf_workers = int(os.getenv('IMAPBOX_PDF_WORKERS')) if os.getenv('IMAPBOX_PDF_WORKERS') else 2
         self.json = self.load_bool(os.getenv('IMAPBOX_JSON'), True)
         self.local_subfolder = self.load_bool(os.getenv('IMAPBOX_LOCAL_SUBFOLDER'), True)
+        self.incremental = self.load_bool(os.getenv('IMAPBOX_INCREMENTAL'), True)
+        self.message_index = self.load_bool(os.getenv('IMAPBOX_MESSAGE_INDEX'), True)
+        self.catalog = self.load_bool(os.getenv('IMAPBOX_CATALOG'), True)
+        self.attachment_store = os.getenv('IMAPBOX_ATTACHMENT_STORE', None)
+        self.fetch_batch_size = int(os.getenv('IMAPBOX_FETCH_BATCH_SIZE')) if os.getenv('IMAPBOX_FETCH_BATCH_SIZE') else 50
+        self.fetch_batch_bytes = int(os.getenv('IMAPBOX_FETCH_BATCH_BYTES')) if os.getenv('IMAPBOX_FETCH_BATCH_BYTES') else 20 * 1024 * 1024
+        self.workers = int(os.getenv('IMAPBOX_WORKERS')) if os.getenv('IMAPBOX_WORKERS') else 1
+        self.connections_per_host = int(os.getenv('IMAPBOX_CONNECTIONS_PER_HOST')) if os.getenv('IMAPBOX_CONNECTIONS_PER_HOST') else 4
+        self.processes = int(os.getenv('IMAPBOX_PROCESSES')) if os.getenv('IMAPBOX_PROCESSES') else 0
+        self.pipeline_bytes = int(os.getenv('IMAPBOX_PIPELINE_BYTES')) if os.getenv('IMAPBOX_PIPELINE_BYTES') else 64 * 1024 * 1024
+        self.spool_size = int(os.getenv('IMAPBOX_SPOOL_SIZE')) if os.getenv('IMAPBOX_SPOOL_SIZE') else 10 * 1024 * 1024
+        self.metrics_file = os.getenv('IMAPBOX_METRICS_FILE', None)
+        self.storage = os.getenv('IMAPBOX_STORAGE', 'folders')
+        self.pack_compression = os.getenv('IMAPBOX_PACK_COMPRESSION', 'zlib')
+        self.pack_segment_size = int(os.getenv('IMAPBOX_PACK_SEGMENT_SIZE')) if os.getenv('IMAPBOX_PACK_SEGMENT_SIZE') else 1024 * 1024 * 1024
+        self.pack_sync_interval = int(os.getenv('IMAPBOX_PACK_SYNC_INTERVAL')) if os.getenv('IMAPBOX_PACK_SYNC_INTERVAL') else 100
+        self.shard_directories = self.load_bool(os.getenv('IMAPBOX_SHARD_DIRECTORIES'), False)
+        self.daemon = self.load_bool(os.getenv('IMAPBOX_DAEMON'), False)
+        self.idle_folders = self.load_list(os.getenv('IMAPBOX_IDLE_FOLDERS', 'INBOX'))
+        self.poll_interval = int(os.getenv('IMAPBOX_POLL_INTERVAL')) if os.getenv('IMAPBOX_POLL_INTERVAL') else 60
+        self.engine = os.getenv('IMAPBOX_ENGINE', 'threads')
         self.accounts: [Account]
         self.accounts = []
         self.load_config()
 
-    def load_bool(self, value, default: bool):
+    @staticmethod
+    def load_bool(value, default: bool):
         if isinstance(value, bool) and value == True:
             return True
         if value is None:
@@ -72,6 +111,9 @@ class Options:
             return True
         return False
 
+    def load_list(self, value):
+        return [item.strip() for item in value.split(',') if item.strip()]
+
     def load_config(self):
         config = configparser.ConfigParser(allow_no_value=True)
         config.read([
@@ -94,9 +136,75 @@ class Options:
             if config.has_option('imapbox', 'wkhtmltopdf'):
                 self.wkhtmltopdf = os.path.expanduser(config.get('imapbox', 'wkhtmltopdf'))
 
+            if config.has_option('imapbox', 'pdf_workers'):
+                self.pdf_workers = config.getint('imapbox', 'pdf_workers')
+
             if config.has_option('imapbox', 'json'):
                 self.json = self.load_bool(config.get('imapbox', 'json'), True)
 
+            if config.has_option('imapbox', 'incremental'):
+                self.incremental = self.load_bool(config.get('imapbox', 'incremental'), True)
+
+            if config.has_option('imapbox', 'message_index'):
+                self.message_index = self.load_bool(config.get('imapbox', 'message_index'), True)
+
+            if config.has_option('imapbox', 'catalog'):
+                self.catalog = self.load_bool(config.get('imapbox', 'catalog'), True)
+
+            if config.has_option('imapbox', 'attachment_store'):
+                self.attachment_store = config.get('imapbox', 'attachment_store')
+
+            if config.has_option('imapbox', 'fetch_batch_size'):
+                self.fetch_batch_size = config.getint('imapbox', 'fetch_batch_size')
+
+            if config.has_option('imapbox', 'fetch_batch_bytes'):
+                self.fetch_batch_bytes = config.getint('imapbox', 'fetch_batch_bytes')
+
+            if config.has_option('imapbox', 'workers'):
+                self.workers = config.getint('imapbox', 'workers')
+
+            if config.has_option('imapbox', 'connections_per_host'):
+                self.connections_per_host = config.getint('imapbox', 'connections_per_host')
+
+            if config.has_option('imapbox', 'processes'):
+                self.processes = config.getint('imapbox', 'processes')
+
+            if config.has_option('imapbox', 'pipeline_bytes'):
+                self.pipeline_bytes = config.getint('imapbox', 'pipeline_bytes')
+
+            if config.has_option('imapbox', 'spool_size'):
+                self.spool_size = config.getint('imapbox', 'spool_size')
+
+            if config.has_option('imapbox', 'metrics_file'):
+                self.metrics_file = os.path.expanduser(config.get('imapbox', 'metrics_file'))
+
+            if config.has_option('imapbox', 'storage'):
+                self.storage = config.get('imapbox', 'storage')
+
+            if config.has_option('imapbox', 'pack_compression'):
+                self.pack_compression = config.get('imapbox', 'pack_compression')
+
+            if config.has_option('imapbox', 'pack_segment_size'):
+                self.pack_segment_size = config.getint('imapbox', 'pack_segment_size')
+
+            if config.has_option('imapbox', 'pack_sync_interval'):
+                self.pack_sync_interval = config.getint('imapbox', 'pack_sync_interval')
+
+            if config.has_option('imapbox', 'shard_directories'):
+                self.shard_directories = self.load_bool(config.get('imapbox', 'shard_directories'), False)
+
+            if config.has_option('imapbox', 'daemon'):
+                self.daemon = self.load_bool(config.get('imapbox', 'daemon'), False)
+
+            if config.has_option('imapbox', 'idle_folders'):
+                self.idle_folders = self.load_list(config.get('imapbox', 'idle_folders'))
+
+            if config.has_option('imapbox', 'poll_interval'):
+                self.poll_interval = config.getint('imapbox', 'poll_interval')
+
+            if config.has_option('imapbox', 'engine'):
+                self.engine = config.get('imapbox', 'engine')
+
         for section in config.sections():
 
             if 'imapbox' == section:
@@ -124,6 +232,12 @@ class Options:
             if config.has_option(section, 'ssl'):
                 account.ssl = self.load_bool(config.get(section, 'ssl'), False)
 
+            if config.has_option(section, 'compress'):
+                account.compress = self.load_bool(config.get(section, 'compress'), True)
+
+            if config.has_option(section, 'max_attachment_size'):
+                account.max_attachment_size = config.getint(section, 'max_attachment_size')
+
             if config.has_option(section, 'remote_folder'):
                 account.remote_folder = config.get(section, 'remote_folder')
 
@@ -148,4 +262,31 @@ class Options:
         if self.args.local_subfolder:
             self.local_subfolder = self.args.local_subfolder
 
-        print('days: {}, local_folder: {}, wkhtmltopdf: {}, json: {}'.format(self.days, self.local_folder, self.wkhtmltopdf, self.json))
+        if self.args.workers:
+            self.workers = self.args.workers
+
+        if self.args.daemon:
+            self.daemon = True
+
+        if self.attachment_store not in (None, '', 'hardlink', 'reference'):
+            print('unknown attachment_store "{}", attachments are stored in each message folder'.format(self.attachment_store))
+            self.attachment_store = None
+
+        if self.storage not in ('folders', 'packed'):
+            print('unknown storage "{}", messages are stored in folders'.format(self.storage))
+            self.storage = 'folders'
+
+        if self.engine not in ('threads', 'asyncio'):
+            print('unknown engine "{}", folders are exported on threads'.format(self.engine))
+            self.engine = 'threads'
+
+        if self.pack_compression in ('', 'none'):
+            self.pack_compression = None
+        elif self.pack_compression not in ('zlib', 'lzma'):
+            print('unknown pack_compression "{}", pack files are compressed with zlib'.format(self.pack_compression))
+            self.pack_compression = 'zlib'
+
+        if self.storage == 'packed' and self.wkhtmltopdf:
+            print('message.pdf files are not rendered with the packed storage, extract the messages to render them')
+
+        print('days: {}, local_folder: {}, wkhtmltopdf: {}, json: {}, incremental: {}, workers: {}'.format(self.days, self.local_folder, self.wkhtmltopdf, self.json, self.incremental, self.workers))
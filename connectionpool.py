@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from configuration import Account
+
+
+class ConnectionPool:
+    """Authenticated IMAP sessions shared between the folders of an account, limited per host
+
+    The bookkeeping methods (take, put, drop, take_all) are called with the condition held,
+    they are shared with AsyncConnectionPool.
+    """
+
+    def __init__(self, connections_per_host):
+        self.connections_per_host = connections_per_host
+        self.condition = threading.Condition()
+        self.idle = {}
+        self.open = {}
+
+    @staticmethod
+    def account_key(account: Account):
+        return account.host, account.port, account.username
+
+    def take(self, account: Account):
+        """(idle session or None, session to log out or None) of a slot for account, None if there is none"""
+        idle = self.idle.get(self.account_key(account))
+        if idle:
+            return idle.pop(), None
+        if self.open.get(account.host, 0) < self.connections_per_host:
+            self.open[account.host] = self.open.get(account.host, 0) + 1
+            return None, None
+        # hand over the slot of an idle session of another account on the same host
+        victim = self.pop_idle(account.host)
+        return (None, victim) if victim is not None else None
+
+    def put(self, account: Account, mailbox):
+        self.idle.setdefault(self.account_key(account), []).append(mailbox)
+        self.condition.notify()
+
+    def drop(self, account: Account):
+        self.open[account.host] -= 1
+        self.condition.notify()
+
+    def take_all(self):
+        idle = [mailbox for mailboxes in self.idle.values() for mailbox in mailboxes]
+        self.idle = {}
+        self.open = {}
+        return idle
+
+    def acquire(self, account: Account):
+        while True:
+            with self.condition:
+                mailbox, victim = self.condition.wait_for(lambda: self.take(account))
+
+            if victim is not None:
+                self.logout(victim)
+
+            if mailbox is None:
+                try:
+                    return account.get_mailbox()
+                except Exception:
+                    self.discard(account)
+                    raise
+
+            try:
+                mailbox.noop()
+                return mailbox
+            except Exception:
+                self.discard(account)
+
+    def pop_idle(self, host):
+        for (idle_host, port, username), idle in self.idle.items():
+            if idle_host == host and idle:
+                return idle.pop()
+        return None
+
+    def release(self, account: Account, mailbox):
+        try:
+            mailbox.close()
+        except Exception:
+            # no folder selected
+            pass
+        with self.condition:
+            self.put(account, mailbox)
+
+    def discard(self, account: Account, mailbox=None):
+        if mailbox is not None:
+            self.logout(mailbox)
+        with self.condition:
+            self.drop(account)
+
+    def close_all(self):
+        with self.condition:
+            idle = self.take_all()
+        for mailbox in idle:
+            self.logout(mailbox)
+
+    @staticmethod
+    def logout(mailbox):
+        try:
+            mailbox.logout()
+        except Exception as e:
+            print(e)
@@ -5,6 +5,7 @@ import datetime
 import os
 
 import crython
+from configuration import Options
 from mailboxclient import Exporter
 
 cron_expr = os.getenv('IMAPBOX_CRON_EXPR', '@hourly')
@@ -17,6 +18,12 @@ def cronjob():
     print("__Job_finished: " + str(datetime.datetime.now()))
 
 
-print('_crython_start: ' + str(datetime.datetime.now()) + " " + cron_expr)
-crython.start()
-crython.join()
+if __name__ == '__main__':
+    if Options.load_bool(os.getenv('IMAPBOX_DAEMON'), False):
+        # the export keeps running and waits for new messages itself
+        print('_daemon_start: ' + str(datetime.datetime.now()))
+        Exporter().run()
+    else:
+        print('_crython_start: ' + str(datetime.datetime.now()) + " " + cron_expr)
+        crython.start()
+        crython.join()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from connectionpool import ConnectionPool
+from idle import IDLE_TIMEOUT
+
+# delays before reconnecting a folder watcher, doubled after each failure
+RECONNECT_DELAY = 5
+RECONNECT_DELAY_MAX = 300
+
+
+class Daemon:
+    """Export the new messages as they arrive instead of once per run
+
+    Each folder of idle_folders has its own session, outside of the connection pool so the
+    watchers never hold the sessions the other folders need, waiting for new messages with
+    IDLE (or polling with NOOP every poll_interval seconds if the server has no IDLE). The
+    other folders are exported every poll_interval seconds with the sessions kept open by
+    the pool, so no login is repeated.
+    """
+
+    def __init__(self, exporter, options, archive, pool, process_pool=None):
+        self.exporter = exporter
+        self.options = options
+        self.archive = archive
+        self.pool = pool
+        self.process_pool = process_pool
+        self.stopping = threading.Event()
+        self.watchers = {}
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+        print('Daemon started, watching {} with IDLE, polling the other folders every {}s'.format(
+            ', '.join(self.options.idle_folders) or 'no folder', self.options.poll_interval))
+        try:
+            while not self.stopping.is_set():
+                self.poll()
+                try:
+                    self.archive.metrics.write()
+                except OSError as e:
+                    print("Couldn't write the metrics file: {}".format(e))
+                self.stopping.wait(self.options.poll_interval)
+        except KeyboardInterrupt:
+            self.stopping.set()
+        print('Daemon stopping')
+        for thread in self.watchers.values():
+            thread.join(5)
+
+    def poll(self):
+        """Export the folders not watched with IDLE, start the watchers of new folders"""
+        with ThreadPoolExecutor(max_workers=max(1, self.options.workers)) as executor:
+            folder_lists = executor.map(lambda account: self.exporter.get_folders(account, self.options, self.pool, self.archive, self.options.idle_folders),
+                                        self.options.accounts)
+            jobs = []
+            for account, folder_options in [job for jobs in folder_lists for job in jobs]:
+                if account.remote_folder in self.options.idle_folders:
+                    self.watch(account, folder_options)
+                else:
+                    jobs.append(executor.submit(self.exporter.safe_mails, account, folder_options, self.archive, self.pool, self.process_pool))
+            for job in jobs:
+                job.result()
+
+    def watch(self, account, options):
+        key = (account.name, account.remote_folder)
+        if key in self.watchers and self.watchers[key].is_alive():
+            return
+        thread = threading.Thread(target=self.watch_folder, args=(account, options), name='watch {}/{}'.format(*key), daemon=True)
+        self.watchers[key] = thread
+        thread.start()
+
+    def watch_folder(self, account, options):
+        """Export a folder each time its session reports changes, reconnect with a growing delay"""
+        delay = RECONNECT_DELAY
+        while not self.stopping.is_set():
+            try:
+                mailbox = account.get_mailbox()
+            except Exception as e:
+                print("Couldn't connect to {}: {}, retrying in {}s".format(account.host, e, delay))
+                self.stopping.wait(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+                continue
+            try:
+                while not self.stopping.is_set():
+                    self.exporter.export_folder(account, options, self.archive, mailbox, self.process_pool)
+                    delay = RECONNECT_DELAY
+                    while not self.stopping.is_set():
+                        if mailbox.has_idle():
+                            changed = mailbox.idle(IDLE_TIMEOUT, self.stopping)
+                        else:
+                            changed = mailbox.poll(self.options.poll_interval, self.stopping)
+                        # an export every IDLE_TIMEOUT at least, in case a change was not reported
+                        if changed or mailbox.has_idle():
+                            break
+            except Exception as e:
+                print("Watching {}/{} failed: {}, reconnecting in {}s".format(account.name, account.remote_folder, e, delay))
+                ConnectionPool.logout(mailbox)
+                self.stopping.wait(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+                continue
+            ConnectionPool.logout(mailbox)
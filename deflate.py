@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import imaplib
+import io
+import ssl
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+COMPRESS_LEVEL = 6
+
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+class DeflateReader(io.RawIOBase):
+    """Raw stream inflating what is received on a socket (raw DEFLATE, RFC 1951)"""
+
+    def __init__(self, sock, data=b''):
+        self.sock = sock
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        # received, not yet inflated
+        self.input = data
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if not self.input:
+                try:
+                    self.input = self.sock.recv(CHUNK_SIZE)
+                except BlockingIOError:
+                    return None
+                if not self.input:
+                    return 0
+            data = self.decompressor.decompress(self.input, len(buffer))
+            self.input = self.decompressor.unconsumed_tail
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+
+
+class DeflateWriter(io.RawIOBase):
+    """Raw stream deflating what is written to a socket, flushed at each write"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.send(self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        return len(data)
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+
+class DeflateMixin:
+    """imaplib connection compressing the commands and the responses with COMPRESS=DEFLATE (RFC 4978)"""
+
+    deflate_writer = None
+
+    def enable_compression(self):
+        """Start compressing if the server supports it, return True if it does"""
+        if 'COMPRESS=DEFLATE' not in self.capabilities:
+            # servers often announce it once authenticated only
+            typ, data = self.capability()
+            if typ == 'OK' and data and data[-1]:
+                self.capabilities = tuple(data[-1].decode().upper().split())
+        if 'COMPRESS=DEFLATE' not in self.capabilities:
+            return False
+        try:
+            typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        except self.abort:
+            raise
+        except self.error:
+            return False
+        if typ != 'OK':
+            return False
+        # compressed data already read with the tagged response
+        data = self.read_buffered()
+        self.file = io.BufferedReader(DeflateReader(self.sock, data), CHUNK_SIZE)
+        self.deflate_writer = DeflateWriter(self.sock)
+        return True
+
+    def read_buffered(self):
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            return self.file.read1(CHUNK_SIZE) or b''
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return b''
+        finally:
+            self.sock.settimeout(timeout)
+
+    def send(self, data):
+        if self.deflate_writer is None:
+            return super().send(data)
+        self.deflate_writer.write(data)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+
+class DirectoryListing:
+    """The entries of the archive directories, each one listed once with a single scandir
+
+    A year directory can hold hundreds of thousands of messages: checking each message
+    with a stat is slow on network filesystems, a lookup in the listing is not. The
+    listing is kept for the life of the archive, the directories created by the export
+    are added to it.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, parent):
+        """The names in the parent directory, listed on the first call"""
+        with self.lock:
+            names = self.entries.get(parent)
+            if names is None:
+                try:
+                    with os.scandir(parent) as it:
+                        names = {entry.name for entry in it}
+                except (FileNotFoundError, NotADirectoryError):
+                    names = set()
+                self.entries[parent] = names
+            return names
+
+    def exists(self, directory):
+        parent, name = os.path.split(os.path.normpath(directory))
+        return name in self.get(parent)
+
+    def add(self, directory):
+        """Record a directory created since the listing"""
+        parent, name = os.path.split(os.path.normpath(directory))
+        names = self.get(parent)
+        with self.lock:
+            names.add(name)
+
+    def discard(self, directory):
+        """Forget a directory removed or renamed since the listing"""
+        parent, name = os.path.split(os.path.normpath(directory))
+        with self.lock:
+            if parent in self.entries:
+                self.entries[parent].discard(name)
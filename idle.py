@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import select
+import ssl
+import time
+
+# RFC 2177: servers may log out clients idling for 30 minutes
+IDLE_TIMEOUT = 29 * 60
+
+# untagged responses telling that the selected folder changed
+CHANGES = ('EXISTS', 'EXPUNGE', 'RECENT')
+
+
+class IdleMixin:
+    """imaplib connection waiting for changes of the selected folder with IDLE (RFC 2177)"""
+
+    def has_idle(self):
+        return 'IDLE' in self.capabilities
+
+    def has_response(self):
+        """True if a response was already received and can be read without blocking"""
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            return bool(self.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+    def clear_changes(self):
+        for name in CHANGES:
+            self.untagged_responses.pop(name, None)
+
+    def has_changes(self):
+        return any(name in self.untagged_responses for name in CHANGES)
+
+    def idle(self, timeout=IDLE_TIMEOUT, stopping=None):
+        """Wait until the selected folder changes, timeout seconds pass or the stopping event is set
+
+        Return True if the server reported a change.
+        """
+        self.clear_changes()
+        tag = self._new_tag()
+        self.send(tag + b' IDLE\r\n')
+        while self._get_response() is not None:
+            if self.tagged_commands[tag] is not None:
+                typ, data = self._get_tagged_response(tag)
+                raise self.error('IDLE command error: %s %s' % (typ, data))
+
+        deadline = time.monotonic() + min(timeout, IDLE_TIMEOUT)
+        while not self.has_changes() and not (stopping is not None and stopping.is_set()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # wake up every second to notice the stopping event
+            if self.has_response() or select.select([self.sock], [], [], min(remaining, 1))[0]:
+                self._get_response()
+                self._check_bye()
+
+        self.send(b'DONE\r\n')
+        typ, data = self._get_tagged_response(tag)
+        if typ != 'OK':
+            raise self.error('IDLE command error: %s %s' % (typ, data))
+        return self.has_changes()
+
+    def poll(self, interval, stopping=None):
+        """Fallback of idle() for servers without IDLE: NOOP every interval seconds"""
+        self.clear_changes()
+        if stopping is not None:
+            stopping.wait(interval)
+        else:
+            time.sleep(interval)
+        self.noop()
+        return self.has_changes()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import email.parser
+import email.policy
+import email.utils
+import datetime
+import io
+import re
+import select
+import socketserver
+import threading
+
+from deflate import DeflateReader, DeflateWriter
+
+HEADER_FIELDS_RE = re.compile(r'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]', re.I)
+RFC822_RE = re.compile(r'(^| )(RFC822|BODY\.PEEK\[\]|BODY\[\])( |$)', re.I)
+SECTION_RE = re.compile(r'BODY(?:\.PEEK)?\[(HEADER|(?:\d+\.)*\d+(?:\.MIME)?)\]', re.I)
+SEARCH_UID_RE = re.compile(r'UID ([\d:*,]+)', re.I)
+SEARCH_SENTSINCE_RE = re.compile(r'SENTSINCE (\S+)', re.I)
+
+
+class StandInMessage:
+    def __init__(self, uid, raw):
+        self.uid = uid
+        self.raw = raw
+        self.headers = email.parser.BytesHeaderParser().parsebytes(raw)
+        try:
+            sent = email.utils.parsedate_to_datetime(self.headers['Date'])
+            self.date = sent.date()
+        except (TypeError, ValueError):
+            sent = datetime.datetime.now(datetime.timezone.utc)
+            self.date = None
+        self.internaldate = sent.strftime('%d-%b-%Y %H:%M:%S %z')
+        self._message = None
+
+    @property
+    def message(self):
+        # parsed on demand, the raw bytes of the parts are kept with surrogateescape
+        if self._message is None:
+            self._message = email.parser.BytesParser(policy=email.policy.compat32).parsebytes(self.raw)
+        return self._message
+
+    def get_section(self, section):
+        """Bytes of a BODY[section] of the message"""
+        if section.upper() == 'HEADER':
+            end = re.search(rb'\r?\n\r?\n', self.raw)
+            return self.raw[:end.end()] if end else self.raw
+        numbers = section.upper().split('.')
+        mime = numbers[-1] == 'MIME'
+        if mime:
+            numbers.pop()
+        part = self.message
+        for number in map(int, numbers):
+            if part.get_content_maintype() == 'multipart':
+                children = part.get_payload()
+                if number > len(children):
+                    return b''
+                part = children[number - 1]
+            elif number != 1:
+                return b''
+        if mime:
+            return ''.join('%s: %s\r\n' % item for item in part.items()).encode('ascii', 'surrogateescape') + b'\r\n'
+        return part_body(part)
+
+    def bodystructure(self, part=None):
+        """BODYSTRUCTURE of the message (RFC 3501), without the envelope of message/rfc822 parts"""
+        part = self.message if part is None else part
+        if part.get_content_maintype() == 'multipart':
+            children = b''.join(self.bodystructure(child) for child in part.get_payload())
+            return b'(%s %s %s NIL NIL NIL)' % (children, quote(part.get_content_subtype().upper()), quote_params(part.get_params()[1:]))
+        body = part_body(part)
+        fields = [quote(part.get_content_maintype().upper()), quote(part.get_content_subtype().upper()), quote_params(part.get_params()[1:]),
+                  quote(part['Content-Id']), quote(part['Content-Description']), quote(part['Content-Transfer-Encoding'] or '7BIT'), b'%d' % len(body)]
+        if part.get_content_maintype() == 'text':
+            fields.append(b'%d' % body.count(b'\n'))
+        elif part.get_content_type() == 'message/rfc822':
+            fields.extend([b'NIL', b'NIL', b'%d' % body.count(b'\n')])
+        disposition = part.get_content_disposition()
+        params = part.get_params(header='content-disposition') or []
+        fields.append(b'NIL' if disposition is None else b'(%s %s)' % (quote(disposition.upper()), quote_params(params[1:])))
+        fields.extend([b'NIL', b'NIL'])
+        return b'(%s)' % b' '.join(fields)
+
+
+def part_body(part):
+    # get_payload() decodes 8bit bodies with their charset
+    payload = part._payload
+    if isinstance(payload, list):
+        return b''.join(message.as_string().encode('ascii', 'surrogateescape') for message in payload)
+    return (payload or '').encode('ascii', 'surrogateescape')
+
+
+def quote(value):
+    """An IMAP string, a literal if it is not plain ASCII"""
+    if value is None:
+        return b'NIL'
+    data = str(value).encode('utf8', 'surrogateescape')
+    if any(byte > 126 or byte in b'\r\n"\\' for byte in data):
+        return b'{%d}\r\n%s' % (len(data), data)
+    return b'"%s"' % data
+
+
+def quote_params(params):
+    if not params:
+        return b'NIL'
+    return b'(%s)' % b' '.join(quote(name.upper()) + b' ' + quote(email.utils.collapse_rfc2231_value(value)) for name, value in params)
+
+
+class StandInMailbox:
+    """A folder of the stand-in server, messages are kept in memory in UID order"""
+
+    def __init__(self, name, uidvalidity=1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.uids = []
+        self.uidnext = 1
+
+    def append(self, raw):
+        self.messages.append(StandInMessage(self.uidnext, raw))
+        self.uids.append(self.uidnext)
+        self.uidnext += 1
+
+    def select(self, spec, uid):
+        """Return [(sequence number, message)] of a sequence set"""
+        if not self.messages:
+            return []
+        last = self.uids[-1] if uid else len(self.messages)
+        indexes = set()
+        for item in spec.split(','):
+            first, _, end = item.partition(':')
+            first = last if first == '*' else int(first)
+            end = first if not end else last if end == '*' else int(end)
+            first, end = min(first, end), max(first, end)
+            if uid:
+                indexes.update(range(bisect.bisect_left(self.uids, first), bisect.bisect_right(self.uids, end)))
+            else:
+                indexes.update(range(max(first, 1) - 1, min(end, len(self.messages))))
+        return [(index + 1, self.messages[index]) for index in sorted(indexes)]
+
+
+class StandInDeflateWriter(DeflateWriter):
+    """Counts the compressed bytes sent"""
+
+    def __init__(self, sock, server):
+        super().__init__(sock)
+        self.server = server
+
+    def send(self, data):
+        super().send(data)
+        self.server.count(0, len(data))
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    """Just enough of IMAP4rev1 for imapbox: LOGIN, LIST, STATUS, SELECT, SEARCH, FETCH, IDLE and COMPRESS"""
+
+    # each response is flushed at once after its tagged line
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.wfile.write(data)
+        if not self.compressed:
+            self.server.count(0, len(data))
+
+    def handle(self):
+        self.selected = None
+        self.exists = 0
+        self.compressed = False
+        self.send('* OK [CAPABILITY IMAP4rev1] imapbox stand-in ready\r\n')
+        self.wfile.flush()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode('utf8', 'replace').rstrip('\r\n')
+            self.server.count(1, 0)
+            tag, _, command = line.partition(' ')
+            name, _, args = command.partition(' ')
+            name = name.upper()
+            uid = name == 'UID'
+            if uid:
+                name, _, args = args.partition(' ')
+                name = name.upper()
+            method = getattr(self, 'do_' + name.lower(), None)
+            result = method(args, uid) if method is not None else 'BAD unknown command'
+            self.send('%s %s\r\n' % (tag, result or 'OK done'))
+            self.wfile.flush()
+            if name == 'LOGOUT':
+                return
+            if name == 'COMPRESS' and self.compressed and not isinstance(self.rfile.raw, DeflateReader):
+                # everything after the tagged response is compressed
+                self.rfile = io.BufferedReader(DeflateReader(self.connection))
+                self.wfile = io.BufferedWriter(StandInDeflateWriter(self.connection, self.server), self.wbufsize)
+
+    def do_capability(self, args, uid):
+        self.send('* CAPABILITY IMAP4rev1 IDLE COMPRESS=DEFLATE\r\n')
+
+    def do_login(self, args, uid):
+        pass
+
+    def do_compress(self, args, uid):
+        if args.strip().upper() != 'DEFLATE':
+            return 'BAD unknown compression mechanism'
+        if self.compressed:
+            return 'NO [COMPRESSIONACTIVE] already compressed'
+        self.compressed = True
+
+    def do_noop(self, args, uid):
+        self.send_exists()
+
+    def do_idle(self, args, uid):
+        self.send('+ idling\r\n')
+        self.wfile.flush()
+        while not select.select([self.connection], [], [], 0.2)[0]:
+            if self.send_exists():
+                self.wfile.flush()
+        if self.rfile.readline().strip().upper() != b'DONE':
+            return 'BAD expected DONE'
+
+    def send_exists(self):
+        """Report the messages appended to the selected folder since it was selected"""
+        if self.selected is None or len(self.selected.messages) == self.exists:
+            return False
+        self.exists = len(self.selected.messages)
+        self.send('* %d EXISTS\r\n' % self.exists)
+        return True
+
+    def do_logout(self, args, uid):
+        self.send('* BYE\r\n')
+
+    def do_list(self, args, uid):
+        for name in self.server.mailboxes:
+            self.send('* LIST (\\HasNoChildren) "." "%s"\r\n' % name)
+
+    def do_select(self, args, uid):
+        name = args.strip('"')
+        if name not in self.server.mailboxes:
+            return 'NO no such mailbox'
+        self.selected = self.server.mailboxes[name]
+        self.exists = len(self.selected.messages)
+        self.send('* FLAGS (\\Seen)\r\n* %d EXISTS\r\n* 0 RECENT\r\n' % self.exists)
+        self.send('* OK [UIDVALIDITY %d] UIDs valid\r\n' % self.selected.uidvalidity)
+        self.send('* OK [UIDNEXT %d] next UID\r\n' % self.selected.uidnext)
+        return 'OK [READ-ONLY] selected'
+
+    do_examine = do_select
+
+    def do_status(self, args, uid):
+        name, _, items = args.rpartition(' (')
+        name = name.strip('"')
+        if name not in self.server.mailboxes:
+            return 'NO no such mailbox'
+        mailbox = self.server.mailboxes[name]
+        values = {'MESSAGES': len(mailbox.messages), 'UIDNEXT': mailbox.uidnext, 'UIDVALIDITY': mailbox.uidvalidity}
+        items = [item for item in items.rstrip(')').upper().split() if item in values]
+        self.send('* STATUS "%s" (%s)\r\n' % (name, ' '.join('%s %d' % (item, values[item]) for item in items)))
+
+    def do_close(self, args, uid):
+        if self.selected is None:
+            return 'BAD no mailbox selected'
+        self.selected = None
+
+    def do_search(self, args, uid):
+        if self.selected is None:
+            return 'BAD no mailbox selected'
+        found = list(enumerate(self.selected.messages, 1))
+        m = SEARCH_UID_RE.search(args)
+        if m:
+            found = self.selected.select(m.group(1), True)
+        m = SEARCH_SENTSINCE_RE.search(args)
+        if m:
+            since = datetime.datetime.strptime(m.group(1), '%d-%b-%Y').date()
+            found = [(seq, message) for seq, message in found if message.date is not None and message.date >= since]
+        self.send('* SEARCH %s\r\n' % ' '.join(str(message.uid if uid else seq) for seq, message in found))
+
+    def do_fetch(self, args, uid):
+        if self.selected is None:
+            return 'BAD no mailbox selected'
+        spec, _, items = args.partition(' ')
+        items = items.strip('()')
+        header_fields = HEADER_FIELDS_RE.search(items)
+        with_raw = RFC822_RE.search(HEADER_FIELDS_RE.sub('', items))
+        for seq, message in self.selected.select(spec, uid):
+            response = [b'* %d FETCH (UID %d' % (seq, message.uid)]
+            if 'RFC822.SIZE' in items.upper():
+                response.append(b' RFC822.SIZE %d' % len(message.raw))
+            if 'INTERNALDATE' in items.upper():
+                response.append(b' INTERNALDATE "%s"' % message.internaldate.encode())
+            if header_fields:
+                data = b''
+                for name in header_fields.group(1).split():
+                    for value in message.headers.get_all(name, []):
+                        data += ('%s: %s\r\n' % (name, value)).encode('utf8', 'replace')
+                data += b'\r\n'
+                response.append(b' BODY[HEADER.FIELDS (%s)] {%d}\r\n' % (header_fields.group(1).upper().encode(), len(data)))
+                response.append(data)
+            if with_raw:
+                response.append(b' RFC822 {%d}\r\n' % len(message.raw))
+                response.append(message.raw)
+            if 'BODYSTRUCTURE' in items.upper():
+                response.append(b' BODYSTRUCTURE ' + message.bodystructure())
+            for section in SECTION_RE.findall(HEADER_FIELDS_RE.sub('', items)):
+                data = message.get_section(section)
+                response.append(b' BODY[%s] {%d}\r\n' % (section.upper().encode(), len(data)))
+                response.append(data)
+            response.append(b')\r\n')
+            self.send(b''.join(response))
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """A local IMAP server stand-in serving {name: StandInMailbox}, without authentication
+
+    commands and bytes_sent count the commands received and the bytes sent on all connections.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailboxes, host='127.0.0.1', port=0):
+        self.mailboxes = mailboxes
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.bytes_sent = 0
+        super().__init__((host, port), StandInHandler)
+
+    def count(self, commands, bytes_sent):
+        with self.lock:
+            self.commands += commands
+            self.bytes_sent += bytes_sent
+
+    def start(self):
+        """Serve in a background thread and return the port"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
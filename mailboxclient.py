@@ -4,83 +4,631 @@
 from __future__ import print_function
 
 import argparse
+import copy
 import datetime
 import os
 import re
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from archive import Archive
+from blobstore import BlobStore
+from bodystructure import parse_bodystructure_response
+from catalog import Catalog
 from configuration import Options, Account
-from message import Message
+from connectionpool import ConnectionPool
+from daemon import Daemon
+from message import UNREADABLE, Message, MessageHeaders, write_message
+from metrics import Metrics
+from packstore import PackStore
+from pipeline import Pipeline, create_process_pool
+from rebuild import Rebuilder
+from spool import SpooledLiteral
 
+FETCH_START_RE = re.compile(rb'^\d+ \(')
+FETCH_LITERAL_RE = re.compile(rb'(BODY\[[^\]]*\]|[\w.]+)(<\d+>)? \{\d+\}$')
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+FETCH_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+FETCH_INTERNALDATE_RE = re.compile(rb'INTERNALDATE "([^"]*)"')
+STATUS_ITEMS_RE = re.compile(rb'\(([^()]*)\)\s*$')
 
-class MailboxClient:
-    """Operations on a mailbox"""
+# STATUS commands sent before reading their responses
+STATUS_BATCH_SIZE = 100
+
+# FETCH items telling whether a message is archived
+HEADER_ITEMS = '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (DATE FROM MESSAGE-ID)])'
+
+# messages listed by each FETCH of a verification
+VERIFY_BATCH_SIZE = 10000
+
+# runs failing to archive a message before the sync state goes past it
+MAX_ATTEMPTS = 3
+
+
+def parse_fetch_response(data):
+    """Group the data of an imaplib FETCH response into one dict per message, keyed by item name"""
+    messages = []
+    current = None
+    for part in data:
+        meta, literal = part if isinstance(part, tuple) else (part, None)
+        if meta is None:
+            continue
+        if FETCH_START_RE.match(meta):
+            current = {}
+            messages.append(current)
+        if current is None:
+            continue
+        m = FETCH_UID_RE.search(meta)
+        if m:
+            current['UID'] = int(m.group(1))
+        m = FETCH_SIZE_RE.search(meta)
+        if m:
+            current['RFC822.SIZE'] = int(m.group(1))
+        m = FETCH_INTERNALDATE_RE.search(meta)
+        if m:
+            current['INTERNALDATE'] = m.group(1).decode()
+        if literal is not None:
+            m = FETCH_LITERAL_RE.search(meta)
+            if m:
+                name = m.group(1).decode().upper()
+                if name.startswith('BODY[HEADER'):
+                    name = 'HEADER'
+                elif name == 'BODY[]':
+                    name = 'RFC822'
+                current[name] = literal
+    return [message for message in messages if 'UID' in message]
+
+
+def parse_status_response(data):
+    """{item: value} of an untagged STATUS response"""
+    m = STATUS_ITEMS_RE.search(data) if isinstance(data, bytes) else None
+    if m is None:
+        return None
+    values = m.group(1).split()
+    return {name.decode().upper(): int(value) for name, value in zip(values[::2], values[1::2])}
+
+
+def get_status_items(capabilities):
+    """STATUS items recorded to tell whether a folder changed"""
+    items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+    if 'CONDSTORE' in capabilities:
+        items.append('HIGHESTMODSEQ')
+    return items
+
+
+def get_folder_status(mailbox, folders):
+    """{folder: {item: value}} of the folders, from STATUS commands pipelined over one session
+
+    Folders whose STATUS fails are left out.
+    """
+    items = get_status_items(mailbox.capabilities)
+    result = {}
+    for batch in chunks(folders, STATUS_BATCH_SIZE):
+        tags = [(folder, mailbox._command('STATUS', folder, '({})'.format(' '.join(items)))) for folder in batch]
+        for folder, tag in tags:
+            try:
+                typ, data = mailbox._command_complete('STATUS', tag)
+            except mailbox.abort:
+                raise
+            except mailbox.error:
+                typ = 'BAD'
+            # the response of this command, the next ones are not read yet
+            responses = mailbox.untagged_responses.pop('STATUS', [])
+            status = parse_status_response(responses[-1]) if typ == 'OK' and responses else None
+            if status:
+                result[folder] = status
+    return result
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class FolderExport:
+    """The archive side of the export of a folder: what is archived, the saved messages, the sync state
 
-    def __init__(self, account: Account, options: Options):
+    MailboxClient drives it with imaplib, AsyncMailboxClient with asyncio.
+    """
+
+    header_batch_size = 500
+
+    def __init__(self, account: Account, options: Options, archive: Archive = None):
         self.options = options
         self.account = account
-        self.mailbox = account.get_mailbox()
-        typ, data = self.mailbox.select(account.remote_folder, readonly=True)
-        if typ != 'OK':
-            # Handle case where Exchange/Outlook uses '.' path separator when
-            # reporting subfolders. Adjust to use '/' on remote.
-            adjust_remote_folder = re.sub('\\.', '/', account.remote_folder)
-            typ, data = self.mailbox.select(adjust_remote_folder, readonly=True)
-            if typ != 'OK':
-                print("MailboxClient: Could not select remote folder '%s'" % account.remote_folder)
-        print(f"{data} messages found.")
+        self.archive = archive
+        self.sync_state = archive.sync_state if archive is not None else None
+        self.pdf_queue = archive.pdf_queue if archive is not None else None
+        self.message_index = archive.message_index if archive is not None else None
+        self.catalog = archive.catalog if archive is not None else None
+        self.pack_store = archive.pack_store if archive is not None else None
+        self.listing = archive.listing if archive is not None else None
+        self.staging_directory = archive.staging_directory if archive is not None else os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'staging'))
+        self.spool_directory = archive.spool_directory if archive is not None else os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'spool'))
+        self.metrics = archive.metrics if archive is not None else Metrics()
+        self.metrics_key = (account.name, account.remote_folder)
+        # recorded in the message index with the messages archived from this folder
+        self.source = '{}/{}'.format(account.name, account.remote_folder)
+        # of the selected folder
+        self.uidvalidity = None
+        # UIDs of the messages fetched without some of their parts
+        self.partial_uids = set()
 
-    def copy_mails(self):
+    def get_select_names(self):
+        """Names to select the folder with, until one works"""
+        # Exchange/Outlook reports subfolders with '.' separators, adjusted to use '/' on remote
+        return [self.account.remote_folder, re.sub('\\.', '/', self.account.remote_folder)]
 
-        n_saved = 0
-        n_exists = 0
+    def get_uidvalidity(self):
+        """UIDVALIDITY of the folder selected by self.mailbox"""
+        typ, data = self.mailbox.response('UIDVALIDITY')
+        if not data or data[0] is None:
+            return None
+        return int(data[0])
+
+    def get_last_uid(self):
+        """Highest UID exported by a previous run, 0 if a full resync is needed"""
+        if self.sync_state is None or self.uidvalidity is None:
+            return 0
+        uidvalidity, last_uid = self.sync_state.get(self.account.name, self.account.remote_folder)
+        if uidvalidity != self.uidvalidity:
+            if uidvalidity is not None:
+                print("UIDVALIDITY of '%s' changed, full resync" % self.account.remote_folder)
+            return 0
+        return last_uid
 
-        criterion = 'ALL'
+    def get_search_criterion(self, last_uid):
+        """SEARCH criterion of the messages to export"""
+        criteria = []
+
+        if last_uid:
+            criteria.append('UID {}:*'.format(last_uid + 1))
 
         if self.options.days:
             date = (datetime.date.today() - datetime.timedelta(self.options.days)).strftime("%d-%b-%Y")
-            criterion = '(SENTSINCE {date})'.format(date=date)
+            criteria.append('SENTSINCE {date}'.format(date=date))
 
-        # self.mailbox.select() already done in init
-        typ, data = self.mailbox.search(None, criterion)
-        for num in data[0].split():
-            typ, data = self.mailbox.fetch(num, '(RFC822)')
-            if self.save_mail(data):
+        return '({})'.format(' '.join(criteria)) if criteria else 'ALL'
+
+    def count_results(self, uids, fetched, results, last_uid):
+        """Record the sync state and the counters of an export, return (created, existing)
+
+        results is {uid: True (saved), False (exists), None (failed) or UNREADABLE} of the
+        fetched messages. The unreadable messages are skipped, the failed ones are fetched
+        again by the next runs, up to MAX_ATTEMPTS times.
+        """
+        n_saved = 0
+        n_exists = 0
+        n_failed = 0
+        synced_uid = last_uid
+        failed = False
+        attempts = self.sync_state.get_failures(self.account.name, self.account.remote_folder) if self.sync_state is not None else {}
+        failures = {}
+
+        for uid in uids:
+            if uid not in fetched:
+                n_exists += 1
+            elif uid not in results:
+                # expunged since the search
+                pass
+            elif results[uid] == UNREADABLE:
+                print("{}/{}: UID {} can't be parsed, skipped".format(self.account.name, self.account.remote_folder, uid))
+                n_failed += 1
+            elif results[uid] is None:
+                n_failed += 1
+                failures[uid] = attempts.get(uid, 0) + 1
+                if failures[uid] < MAX_ATTEMPTS:
+                    failed = True
+                    continue
+                print("{}/{}: UID {} failed {} times, skipped".format(self.account.name, self.account.remote_folder, uid, failures[uid]))
+                del failures[uid]
+            elif results[uid]:
                 n_saved += 1
             else:
                 n_exists += 1
+            if not failed:
+                synced_uid = uid
+
+        # the STATUS taken before the export, only once all its messages are archived
+        self.save_checkpoint(synced_uid, None if failed else self.account.status, failures)
+
+        self.metrics.count(self.metrics_key, 'messages_found', len(uids))
+        self.metrics.count(self.metrics_key, 'messages_created', n_saved)
+        self.metrics.count(self.metrics_key, 'messages_existing', n_exists)
+        self.metrics.count(self.metrics_key, 'messages_failed', n_failed)
 
         return n_saved, n_exists
 
+    def get_archived_position(self, uids, position, end, fetched, results, complete=True):
+        """Index in uids[:end] of the first message from position that is not archived yet
+
+        Without complete, the fetched messages without a result are still being written.
+        """
+        while position < end:
+            uid = uids[position]
+            if uid in fetched and (results.get(uid, False) is None or (uid not in results and not complete)):
+                break
+            position += 1
+        return position
+
+    def save_progress(self, uids, checkpoint, end, fetched, results, complete=True):
+        """Save the checkpoint of the messages archived without a gap in uids[:end], return its position
+
+        An interrupted export resumes after this checkpoint.
+        """
+        position = self.get_archived_position(uids, checkpoint, end, fetched, results, complete)
+        if position > checkpoint:
+            self.save_checkpoint(uids[position - 1])
+        return position
+
+    def save_checkpoint(self, synced_uid, status=None, failures=None):
+        """Record that the messages up to synced_uid are archived, and the {uid: attempts} of the failed ones after it"""
+        if self.pack_store is not None:
+            # the messages must be on disk before the sync state skips them
+            self.pack_store.sync()
+        if self.sync_state is not None and self.uidvalidity is not None:
+            self.sync_state.set(self.account.name, self.account.remote_folder, self.uidvalidity, synced_uid, status, failures)
+
+    def select_missing(self, uids, items):
+        """{uid: size} of the messages not yet archived, from the FETCH items of their headers"""
+        missing = dict.fromkeys(uids)
+        for item in items:
+            if item['UID'] not in missing:
+                continue
+            try:
+                if self.is_archived(MessageHeaders(item['HEADER'], self.options.local_folder, self.listing, self.options.shard_directories)):
+                    del missing[item['UID']]
+                    self.metrics.count(self.metrics_key, 'messages_skipped')
+                    self.metrics.count(self.metrics_key, 'bytes_skipped', item.get('RFC822.SIZE', 0))
+                    continue
+            except Exception:
+                # let the full fetch report broken headers
+                pass
+            if 'RFC822.SIZE' in item:
+                missing[item['UID']] = item['RFC822.SIZE']
+        return missing
+
+    def is_archived(self, headers: MessageHeaders):
+        if self.message_index is not None and self.message_index.get(headers.message_id, self.options.local_folder):
+            return True
+        if headers.exists and self.message_index is not None:
+            # archived before the index existed
+            self.message_index.add(headers.message_id, self.options.local_folder, headers.directory)
+        return headers.exists or (self.pack_store is not None and self.pack_store.contains(headers.directory))
+
+    def split_missing(self, missing):
+        """(UID batches fetched whole, UIDs fetched part by part) of the messages of {uid: size}"""
+        # messages too large, or of unknown size, are fetched part by part
+        max_size = self.account.max_attachment_size
+        large = [uid for uid, size in missing.items() if max_size and (size is None or size > max_size)]
+        small = {uid: size for uid, size in missing.items() if not max_size or (size is not None and size <= max_size)}
+        return list(self.get_fetch_batches(small)), large
+
+    def split_partial(self, uids, structures):
+        """(UID batches fetched whole, UIDs fetched without some parts) of the messages with {uid: BodyStructure}"""
+        max_size = self.account.max_attachment_size
+        partial = [uid for uid in uids if uid in structures and structures[uid].omitted(max_size)]
+        omitted = set(partial)
+        return list(self.get_fetch_batches(dict.fromkeys(uid for uid in uids if uid not in omitted))), partial
+
+    def read_messages(self, items):
+        """[(uid, raw)] of the FETCH items of full messages"""
+        messages = []
+        for item in items:
+            if 'RFC822' in item:
+                self.metrics.count(self.metrics_key, 'messages_fetched')
+                self.metrics.count(self.metrics_key, 'bytes_fetched', len(item['RFC822']))
+                messages.append((item['UID'], item['RFC822']))
+        return messages
+
+    def read_partial(self, uid, structure, items):
+        """[(uid, raw)] of the FETCH items of a message fetched without its parts above max_attachment_size"""
+        max_size = self.account.max_attachment_size
+        messages = []
+        for item in items:
+            if item['UID'] != uid:
+                continue
+            raw = structure.assemble(item, max_size, self.spool_directory)
+            omitted = structure.omitted(max_size)
+            self.metrics.count(self.metrics_key, 'messages_fetched')
+            self.metrics.count(self.metrics_key, 'bytes_fetched', len(raw))
+            self.metrics.count(self.metrics_key, 'attachments_omitted', len(omitted))
+            self.metrics.count(self.metrics_key, 'bytes_omitted', sum(part.size for part in omitted))
+            self.partial_uids.add(uid)
+            messages.append((uid, raw))
+        return messages
+
+    def get_fetch_batches(self, sizes):
+        """Group {uid: size} into UID lists bounded by fetch_batch_size and fetch_batch_bytes"""
+        batch = []
+        batch_bytes = 0
+        for uid, size in sizes.items():
+            size = size or 0
+            if batch and (len(batch) >= self.options.fetch_batch_size or batch_bytes + size > self.options.fetch_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(uid)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def save_mail(self, raw, partial=False):
+        if raw is None:
+            return None
+        message = None
+        # only the errors of the parse and the rendering make a message unreadable, not those of the archive
+        parsing = True
+        try:
+            # the files are collected, then appended to a pack or written with write_message
+            message = Message(raw, self.options.local_folder, [], self.listing, self.options.shard_directories, partial)
+            index_key = message.get_index_key() if self.message_index is not None else None
+            parsing = False
+            if self.message_index is not None and self.message_index.get(index_key, self.options.local_folder):
+                return False
+            if self.pack_store is not None:
+                if self.pack_store.contains(message.directory):
+                    return False
+            elif message.exists:
+                return False
+            parsing = True
+            message.create_files(self.options.json, self.archive.blob_store if self.archive is not None else None)
+            parsing = False
+
+            if self.pack_store is not None:
+                # added to the message index by the pack store once on disk
+                if not message.timed('write', self.pack_store.add, message.directory, message.files, index_key, self.options.local_folder):
+                    return False
+            else:
+                if not message.timed('write', write_message, message.directory, message.files, self.staging_directory, self.listing):
+                    return False
+                if self.message_index is not None:
+                    self.message_index.add(index_key, self.options.local_folder, message.directory, self.source)
+
+            if self.catalog is not None:
+                message.timed('catalog', self.catalog.add, message.directory, message.metadata)
+
+            if self.pdf_queue is not None:
+                self.pdf_queue.put(message.directory)
+
+        except Exception as e:
+            print("MailboxClient.saveEmail() failed")
+            print(e)
+            return UNREADABLE if parsing and not isinstance(e, (OSError, MemoryError, sqlite3.Error)) else None
+        finally:
+            if message is not None:
+                self.metrics.add_timings(self.metrics_key, message.timings)
+            if isinstance(raw, SpooledLiteral):
+                raw.remove()
+
+        return True
+
+
+class MailboxClient(FolderExport):
+    """Operations on a mailbox"""
+
+    def __init__(self, account: Account, options: Options, archive: Archive = None, mailbox=None, process_pool=None):
+        super().__init__(account, options, archive)
+        self.process_pool = process_pool
+        self.own_mailbox = mailbox is None
+        self.mailbox = account.get_mailbox() if mailbox is None else mailbox
+        self.mailbox.spool_size = options.spool_size
+        self.mailbox.spool_directory = self.spool_directory
+        with self.metrics.timer(self.metrics_key, 'select'):
+            for name in self.get_select_names():
+                typ, data = self.mailbox.select(name, readonly=True)
+                if typ == 'OK':
+                    break
+        if typ != 'OK':
+            print("MailboxClient: Could not select remote folder '%s'" % account.remote_folder)
+        print(f"{data} messages found.")
+        self.message_count = int(data[0]) if typ == 'OK' and data and data[0] else 0
+        self.uidvalidity = self.get_uidvalidity()
+
+    def search_uids(self, last_uid):
+        criterion = self.get_search_criterion(last_uid)
+
+        # self.mailbox.select() already done in init
+        with self.metrics.timer(self.metrics_key, 'search'):
+            typ, data = self.mailbox.uid('SEARCH', None, criterion)
+        # "UID n:*" always matches the last message, even if its UID is lower than n
+        return [uid for uid in map(int, data[0].split()) if uid > last_uid]
+
+    def copy_mails(self):
+        last_uid = self.get_last_uid()
+
+        uids = self.search_uids(last_uid)
+        fetched = set()
+        results = {}
+        pipeline = Pipeline(self.process_pool, self.options, self.options.local_folder, self.archive, self.metrics_key) if self.process_pool else None
+
+        checkpoint = 0
+        for start in range(0, len(uids), self.header_batch_size):
+            batch = uids[start:start + self.header_batch_size]
+            missing = self.get_missing_uids(batch)
+            fetched.update(missing)
+            for uid, raw in self.fetch_missing(missing):
+                if pipeline is not None:
+                    pipeline.submit(uid, raw, uid in self.partial_uids)
+                else:
+                    results[uid] = self.save_mail(raw, uid in self.partial_uids)
+            end = start + len(batch)
+            if end < len(uids):
+                checkpoint = self.save_progress(uids, checkpoint, end, fetched, pipeline.results if pipeline is not None else results, pipeline is None)
+
+        if pipeline is not None:
+            results = pipeline.join()
+
+        return self.count_results(uids, fetched, results, last_uid)
+
+    def get_missing_uids(self, uids):
+        """Fetch only the headers of the given messages and return {uid: size} of those not yet archived"""
+        uid_set = ','.join(map(str, uids))
+        with self.metrics.timer(self.metrics_key, 'headers'):
+            typ, data = self.mailbox.uid('FETCH', uid_set, HEADER_ITEMS)
+        if typ != 'OK':
+            return dict.fromkeys(uids)
+
+        return self.select_missing(uids, parse_fetch_response(data))
+
+    def fetch_missing(self, missing):
+        """Fetch the messages of {uid: size} and yield (uid, raw)"""
+        batches, large = self.split_missing(missing)
+        for fetch_uids in batches:
+            yield from self.fetch_mails(fetch_uids)
+        if large:
+            yield from self.fetch_partial_mails(large)
+
+    def fetch_mails(self, uids):
+        """Fetch the full messages of a batch with a single command and yield (uid, raw)"""
+        with self.metrics.timer(self.metrics_key, 'fetch'):
+            typ, data = self.mailbox.uid('FETCH', ','.join(map(str, uids)), '(RFC822)')
+            items = parse_fetch_response(data) if typ == 'OK' else []
+        if typ != 'OK':
+            print("MailboxClient: Could not fetch messages %s" % uids)
+            for uid in uids:
+                yield uid, None
+            return
+        yield from self.read_messages(items)
+
+    def fetch_partial_mails(self, uids):
+        """Fetch the messages without their parts above max_attachment_size and yield (uid, raw)
+
+        The BODYSTRUCTURE of the messages tells their parts, then each message is fetched
+        with the headers of all its parts and the bodies of the parts to keep only.
+        """
+        max_size = self.account.max_attachment_size
+        structures = {}
+        for batch in chunks(uids, self.options.fetch_batch_size):
+            with self.metrics.timer(self.metrics_key, 'headers'):
+                typ, data = self.mailbox.uid('FETCH', ','.join(map(str, batch)), '(BODYSTRUCTURE)')
+            if typ == 'OK':
+                structures.update(parse_bodystructure_response(data))
+        batches, partial = self.split_partial(uids, structures)
+        for fetch_uids in batches:
+            yield from self.fetch_mails(fetch_uids)
+
+        for uid in partial:
+            structure = structures[uid]
+            with self.metrics.timer(self.metrics_key, 'fetch'):
+                typ, data = self.mailbox.uid('FETCH', str(uid), '({})'.format(' '.join(structure.fetch_items(max_size))))
+                items = parse_fetch_response(data) if typ == 'OK' else []
+            if typ != 'OK':
+                print("MailboxClient: Could not fetch message %s" % uid)
+                yield uid, None
+                continue
+            yield from self.read_partial(uid, structure, items)
+
+    def list_messages(self):
+        """UID, RFC822.SIZE, INTERNALDATE and locating headers of all the messages, in a few FETCH commands"""
+        items = []
+        for start in range(1, self.message_count + 1, VERIFY_BATCH_SIZE):
+            end = min(start + VERIFY_BATCH_SIZE - 1, self.message_count)
+            with self.metrics.timer(self.metrics_key, 'headers'):
+                typ, data = self.mailbox.fetch('{}:{}'.format(start, end), '(UID RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER.FIELDS (DATE FROM MESSAGE-ID)])')
+            if typ != 'OK':
+                raise self.mailbox.error('could not list the messages {}:{}'.format(start, end))
+            items.extend(parse_fetch_response(data))
+        return items
+
+    def verify_mails(self, repair=False):
+        """Compare the folder with the archive without fetching the bodies, return (verified, missing, truncated, archived again)
+
+        A message is missing when its message.eml is not in the archive, truncated when the size
+        of its message.eml is not its RFC822.SIZE. With repair, these messages are fetched and
+        archived again.
+        """
+        items = self.list_messages()
+        if self.options.days:
+            wanted = set(self.search_uids(0))
+            items = [item for item in items if item['UID'] in wanted]
+
+        directories = {}
+        problems = []
+        for item in items:
+            try:
+                headers = MessageHeaders(item.get('HEADER', b''), self.options.local_folder, self.listing, self.options.shard_directories)
+            except Exception:
+                # could not be archived either
+                problems.append((item, None, None, 'missing'))
+                continue
+            directory = self.message_index.get(headers.message_id, self.options.local_folder) if self.message_index is not None else None
+            # a copy archived from another folder has the size of that copy, only its presence is checked
+            own = directory is None or self.options.local_subfolder or self.message_index.get_source(headers.message_id, self.options.local_folder) == self.source
+            directories.setdefault(directory or headers.directory, []).append((item, headers, own))
+        for directory, messages in directories.items():
+            # messages with the same date and sender share a directory, the first one is archived
+            state = self.check_directory(directory, [item.get('RFC822.SIZE') if own else None for item, headers, own in messages])
+            if state is not None:
+                problems.extend((item, headers, directory, state) for item, headers, own in messages)
+
+        for item, headers, directory, state in problems:
+            print('{}/{}: {} UID {} of {} ({}) {}'.format(self.account.name, self.account.remote_folder, state, item['UID'], item.get('INTERNALDATE'),
+                                                         headers.message_id if headers is not None else None, directory or ''))
+        missing = sum(1 for problem in problems if problem[3] == 'missing')
+        repaired = self.repair_mails(problems) if repair and problems else 0
+        return len(items), missing, len(problems) - missing, repaired
+
+    def check_directory(self, directory, sizes):
+        """None if the message.eml of directory has one of the sizes, else 'missing' or 'truncated'"""
+        if self.pack_store is not None:
+            # the size of the files is not indexed
+            return None if self.pack_store.contains(directory) else 'missing'
+        try:
+            size = os.stat(os.path.join(directory, 'message.eml')).st_size
+        except OSError:
+            return 'missing'
+        if None in sizes or size in sizes:
+            return None
+        max_size = self.account.max_attachment_size
+        if max_size and max(sizes) > max_size and size < max(sizes):
+            # fetched without its large parts
+            return None
+        return 'truncated'
+
+    def repair_mails(self, problems):
+        """Fetch and archive again the missing and truncated messages, return the number archived"""
+        moved = {}
+        for item, headers, directory, state in problems:
+            if headers is not None and self.message_index is not None and self.message_index.get(headers.message_id, self.options.local_folder) == directory:
+                # the copies of the other folders stay indexed
+                self.message_index.remove(headers.message_id, self.options.local_folder)
+            if directory is None or directory in moved:
+                continue
+            if self.pack_store is None and os.path.isdir(directory):
+                # kept until the message is archived again
+                moved[directory] = directory + '.truncated'
+                os.rename(directory, moved[directory])
+            if self.listing is not None:
+                self.listing.discard(directory)
+
+        results = {}
+        for uid, raw in self.fetch_missing({item['UID']: item.get('RFC822.SIZE') for item, headers, directory, state in problems}):
+            results[uid] = self.save_mail(raw, uid in self.partial_uids)
+        if self.pack_store is not None:
+            self.pack_store.sync()
+
+        for directory, truncated in moved.items():
+            if os.path.exists(os.path.join(directory, 'message.eml')):
+                shutil.rmtree(truncated)
+            else:
+                print("Couldn't archive {} again, the truncated message is kept".format(directory))
+                shutil.rmtree(directory, ignore_errors=True)
+                os.rename(truncated, directory)
+        return sum(1 for saved in results.values() if saved)
+
     def cleanup(self):
+        if not self.own_mailbox:
+            # the session goes back to the pool
+            return
         try:
             self.mailbox.close()
         except Exception as e:
             print(e)
         self.mailbox.logout()
 
-    def save_mail(self, data):
-        for response_part in data:
-            if isinstance(response_part, tuple):
-                try:
-                    message = Message(response_part[1], self.options.local_folder)
-                    if message.exists:
-                        return False
-                    message.create_file_raw()
-                    message.create_file_text()
-                    message.create_file_html()
-                    message.create_file_attachments()
-                    if self.options.json:
-                        message.create_file_json()
-
-                    if self.options.wkhtmltopdf:
-                        message.create_file_pdf(self.options.wkhtmltopdf)
-
-                except Exception as e:
-                    print("MailboxClient.saveEmail() failed")
-                    print(e)
-
-        return True
-
 
 class Exporter:
     def run(self):
@@ -91,28 +639,240 @@ class Exporter:
         argparser.add_argument('-a', dest='specific_account', help="Select a specific account to backup")
         argparser.add_argument('-j', dest='json', help="Output JSON", type=bool)
         argparser.add_argument('-s', dest='local_subfolder', help="Create local subfolder like online", type=bool)
+        argparser.add_argument('-p', dest='workers', help="Number of accounts and folders exported in parallel", type=int)
+        argparser.add_argument('--render-pdf', dest='render_pdf', help="Render the missing message.pdf files of the archive and exit", action='store_true')
+        argparser.add_argument('--rebuild-catalog', dest='rebuild_catalog', help="Catalog again all the messages of the archive and exit", action='store_true')
+        argparser.add_argument('--search', dest='search', help="Search the catalog (SQLite full-text query) and exit")
+        argparser.add_argument('--after', dest='after', help="With --search, only the messages sent from this date (YYYY-MM-DD)")
+        argparser.add_argument('--before', dest='before', help="With --search, only the messages sent before this date (YYYY-MM-DD)")
+        argparser.add_argument('--limit', dest='limit', help="With --search, maximum number of messages listed", type=int, default=50)
+        argparser.add_argument('--extract', dest='extract', help="Write the messages of the packed storage into this folder, in the folder layout, and exit")
+        argparser.add_argument('--extract-prefix', dest='extract_prefix', help="With --extract, only the messages whose folder starts with this path (e.g. INBOX/2023)", default='')
+        argparser.add_argument('--rebuild-pack-index', dest='rebuild_pack_index', help="Rebuild the index of the packed storage from its pack files and exit", action='store_true')
+        argparser.add_argument('--rebuild', dest='rebuild', help="Render again from their message.eml the files of the archived messages that are missing or older, and exit", action='store_true')
+        argparser.add_argument('--rebuild-all', dest='rebuild_all', help="Render again the files of all the archived messages from their message.eml, and exit", action='store_true')
+        argparser.add_argument('--daemon', dest='daemon', help="Keep running and export the new messages as they arrive", action='store_true')
+        argparser.add_argument('--verify', dest='verify', help="List the messages of the folders, report those missing or truncated in the archive, and exit", action='store_true')
+        argparser.add_argument('--repair', dest='repair', help="With --verify, fetch and archive again the missing and truncated messages", action='store_true')
         args = argparser.parse_args()
         options = Options(args)
-        account: Account
-        for account in options.accounts:
-
-            print('{}/{} (on {})'.format(account.name, account.remote_folder, account.host))
-
-            if account.remote_folder == "__ALL__":
-                basedir = options.local_folder
-                for folder_name in account.get_folder_fist():
-                    print("Saving folder: " + folder_name)
-                    account.remote_folder = folder_name
-                    if options.local_subfolder:
-                        options.local_folder = os.path.join(basedir, folder_name)
-                    self.safe_mails(account, options)
-                options.local_folder = basedir
-                account.remote_folder = "__ALL__"
-            else:
-                self.safe_mails(account, options)
 
-    def safe_mails(self, account, options):
-        mailbox_client = MailboxClient(account, options)
-        stats = mailbox_client.copy_mails()
-        mailbox_client.cleanup()
-        print('{} emails created, {} emails already exists'.format(stats[0], stats[1]))
+        if args.extract or args.rebuild_pack_index:
+            self.use_pack_store(options, args)
+            return
+
+        if args.search or args.rebuild_catalog:
+            self.use_catalog(options, args)
+            return
+
+        if args.rebuild or args.rebuild_all:
+            self.rebuild(options, args)
+            return
+
+        archive = Archive(options)
+
+        if args.render_pdf:
+            if archive.pdf_queue is None:
+                print("Couldn't render PDF messages, wkhtmltopdf is not configured")
+                return
+            print('{} PDF messages to render'.format(archive.pdf_queue.put_missing()))
+            archive.close()
+            return
+
+        pool = ConnectionPool(options.connections_per_host)
+        process_pool = create_process_pool(options.processes) if options.processes else None
+        try:
+            if args.verify:
+                self.verify(options, archive, pool, args.repair)
+                return
+            if options.daemon:
+                Daemon(self, options, archive, pool, process_pool).run()
+                return
+            if options.engine == 'asyncio':
+                # imported here, the asyncio engine builds on this module
+                from asyncengine import AsyncExporter
+                AsyncExporter(self, options, archive, process_pool).run()
+                return
+            with ThreadPoolExecutor(max_workers=max(1, options.workers)) as executor:
+                folder_lists = executor.map(lambda account: self.get_folders(account, options, pool, archive), options.accounts)
+                jobs = [
+                    executor.submit(self.safe_mails, account, folder_options, archive, pool, process_pool)
+                    for account, folder_options in [job for jobs in folder_lists for job in jobs]
+                ]
+                for job in jobs:
+                    job.result()
+        finally:
+            pool.close_all()
+            if process_pool is not None:
+                process_pool.shutdown()
+            archive.close()
+
+    def verify(self, options, archive, pool, repair=False):
+        totals = [0, 0, 0, 0]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, options.workers)) as executor:
+            # no archive: the folders whose STATUS did not change are verified too
+            folder_lists = executor.map(lambda account: self.get_folders(account, options, pool), options.accounts)
+            jobs = [
+                executor.submit(self.verify_folder, account, folder_options, archive, pool, repair)
+                for account, folder_options in [job for jobs in folder_lists for job in jobs]
+            ]
+            for job in jobs:
+                stats = job.result()
+                if stats is not None:
+                    totals = [total + value for total, value in zip(totals, stats)]
+        print('{} messages verified, {} missing, {} truncated, {} archived again, in {:.1f}s'.format(*totals, time.perf_counter() - start))
+
+    def verify_folder(self, account, options, archive, pool, repair=False):
+        """Verify a folder, return (verified, missing, truncated, archived again) or None if it failed"""
+        try:
+            mailbox = pool.acquire(account)
+        except Exception as e:
+            print("Couldn't connect to {}: {}".format(account.host, e))
+            return None
+        try:
+            mailbox_client = MailboxClient(account, options, archive, mailbox)
+            stats = mailbox_client.verify_mails(repair)
+            mailbox_client.cleanup()
+        except Exception as e:
+            print("Exporter: verifying {}/{} failed".format(account.name, account.remote_folder))
+            print(e)
+            pool.discard(account, mailbox)
+            return None
+        pool.release(account, mailbox)
+        print('{}/{}: {} messages verified, {} missing, {} truncated, {} archived again'.format(account.name, account.remote_folder, *stats))
+        return stats
+
+    def use_pack_store(self, options, args):
+        if options.storage != 'packed':
+            print("The archive doesn't use the packed storage")
+            return
+        pack_store = PackStore(options.local_folder, options.pack_compression)
+        try:
+            if args.rebuild_pack_index:
+                print('{} files indexed'.format(pack_store.reindex()))
+            if args.extract:
+                blob_store = BlobStore(os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'blobs')), options.attachment_store) if options.attachment_store else None
+                print('{} messages extracted'.format(pack_store.extract(args.extract, args.extract_prefix, blob_store)))
+        finally:
+            pack_store.close()
+
+    def rebuild(self, options, args):
+        if options.storage == 'packed':
+            print("Couldn't rebuild the messages of the packed storage, extract them first")
+            return
+        blob_store = BlobStore(os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'blobs')), options.attachment_store) if options.attachment_store else None
+        processes = options.processes or os.cpu_count() or 1
+        rebuilder = Rebuilder(options, blob_store, args.rebuild_all)
+        start = time.perf_counter()
+        with create_process_pool(processes) as process_pool:
+            rebuilt, up_to_date, failed = rebuilder.run(process_pool, processes)
+        print('{} messages rebuilt, {} up to date, {} failed, in {:.1f}s'.format(rebuilt, up_to_date, failed, time.perf_counter() - start))
+
+    def use_catalog(self, options, args):
+        catalog = Catalog(options.local_folder)
+        pack_store = PackStore(options.local_folder, options.pack_compression) if options.storage == 'packed' and args.rebuild_catalog else None
+        try:
+            if args.rebuild_catalog:
+                print('{} messages cataloged'.format(catalog.rebuild(pack_store)))
+            if args.search:
+                for utc, sender, subject, directory in catalog.search(args.search, args.after, args.before, args.limit):
+                    print('{}  {}  {}\n    {}'.format(utc, sender, subject, directory))
+        except sqlite3.Error as e:
+            print("Couldn't search the catalog: {}".format(e))
+        except ValueError:
+            print("Couldn't search the catalog: --after and --before are dates like 2024-01-31")
+        finally:
+            catalog.close()
+            if pack_store is not None:
+                pack_store.close()
+
+    def get_folders(self, account, options, pool, archive=None, keep=()):
+        """Return (account, options) for each folder to export, with remote_folder and local_folder set
+
+        With the incremental export, the folders whose STATUS did not change since their last
+        export are left out, except those of keep.
+        """
+        print('{}/{} (on {})'.format(account.name, account.remote_folder, account.host))
+
+        if account.remote_folder != "__ALL__":
+            return [(account, options)]
+
+        sync_state = archive.sync_state if archive is not None else None
+        try:
+            mailbox = pool.acquire(account)
+        except Exception as e:
+            print("Couldn't connect to {}: {}".format(account.host, e))
+            return []
+        try:
+            folder_names = account.get_folder_fist(mailbox)
+        except Exception as e:
+            pool.discard(account, mailbox)
+            print("Couldn't list folders of {}: {}".format(account.name, e))
+            return []
+        statuses = {}
+        if sync_state is not None:
+            try:
+                statuses = get_folder_status(mailbox, folder_names)
+            except Exception as e:
+                print("Couldn't get the status of the folders of {}: {}".format(account.name, e))
+                pool.discard(account, mailbox)
+                mailbox = None
+        if mailbox is not None:
+            pool.release(account, mailbox)
+        return self.select_folders(account, options, folder_names, statuses, archive, keep)
+
+    def select_folders(self, account, options, folder_names, statuses, archive=None, keep=()):
+        """(account, options) of the folders to export, those whose STATUS did not change left out"""
+        sync_state = archive.sync_state if archive is not None else None
+        folders = []
+        unchanged = 0
+        for folder_name in folder_names:
+            folder_account = copy.copy(account)
+            folder_account.remote_folder = folder_name
+            folder_account.status = statuses.get(folder_name)
+            if folder_account.status is not None and folder_name not in keep and sync_state.get_status(account.name, folder_name) == folder_account.status:
+                archive.metrics.count((account.name, folder_name), 'folders_unchanged')
+                unchanged += 1
+                continue
+            folder_options = copy.copy(options)
+            if options.local_subfolder:
+                folder_options.local_folder = os.path.join(options.local_folder, folder_name)
+            folders.append((folder_account, folder_options))
+        if unchanged:
+            print('{}: {} unchanged folders skipped'.format(account.name, unchanged))
+        return folders
+
+    def safe_mails(self, account, options, archive=None, pool=None, process_pool=None):
+        print("Saving folder: {}/{}".format(account.name, account.remote_folder))
+        metrics = archive.metrics if archive is not None else Metrics()
+        start = time.perf_counter()
+        try:
+            with metrics.timer((account.name, account.remote_folder), 'connect'):
+                mailbox = pool.acquire(account) if pool is not None else None
+        except Exception as e:
+            print("Couldn't connect to {}: {}".format(account.host, e))
+            return
+        try:
+            self.export_folder(account, options, archive, mailbox, process_pool, start)
+        except Exception as e:
+            print("Exporter: saving {}/{} failed".format(account.name, account.remote_folder))
+            print(e)
+            if pool is not None:
+                pool.discard(account, mailbox)
+            return
+        if pool is not None:
+            pool.release(account, mailbox)
+
+    def export_folder(self, account, options, archive=None, mailbox=None, process_pool=None, start=None):
+        """Export a folder with an open session (a new one if mailbox is None), return (created, existing)"""
+        metrics = archive.metrics if archive is not None else Metrics()
+        start = start if start is not None else time.perf_counter()
+        try:
+            mailbox_client = MailboxClient(account, options, archive, mailbox, process_pool)
+            stats = mailbox_client.copy_mails()
+            mailbox_client.cleanup()
+        finally:
+            metrics.add_duration((account.name, account.remote_folder), time.perf_counter() - start)
+        print('{}/{}: {} emails created, {} emails already exists, in {:.1f}s'.format(account.name, account.remote_folder, stats[0], stats[1], time.perf_counter() - start))
+        return stats
@@ -3,21 +3,28 @@
 
 import datetime
 import email
+import hashlib
 from email.errors import HeaderParseError
 from email.utils import parseaddr
 from email.header import decode_header
+from functools import cached_property
 import re
 import os
 import json
-import io
 import mimetypes
 import chardet
 import html
 import time
 import pkgutil
+import shutil
+import uuid
 
 import unidecode
 
+from blobstore import Blob
+from bodystructure import OMITTED_HEADER, PARTIAL_FILE, PARTIAL_HEADER
+from spool import SpooledLiteral, get_spooled_payload
+
 # import pdfkit if its loader is available
 has_pdfkit = pkgutil.find_loader('pdfkit') is not None
 if has_pdfkit:
@@ -47,40 +54,38 @@ addr_spec = local + "\\@" + domain
 
 email_address_re = re.compile('^' + addr_spec + '$')
 
+body_start_re = re.compile('<body[^>]*>', re.I)
+body_end_re = re.compile('</body>', re.I)
+cid_src_re = re.compile('src=["\']cid:([^"\']*)["\']', re.I)
 
-class Message:
-    """Operation on a message"""
+# bytes of a part given to chardet when it has no charset
+CHARSET_SAMPLE_SIZE = 64 * 1024
 
-    def __init__(self, raw, parent_directory):
-        self.exists = True
-        self.raw = raw
+
+class MessageHeaders:
+    """The headers of a message, enough to locate its archive directory"""
+
+    def __init__(self, raw, parent_directory, listing=None, shard=False):
         self.msg = email.message_from_bytes(raw)
-        self.parts = self.get_parts()
         self.from_ = self.get_addresses('from')
         self.from_ = ('', '') if not self.from_ else self.from_[0]
-        self.tos = self.get_addresses('to')
-        self.ccs = self.get_addresses('cc')
-        self.subject = self.get_header(self.msg.get('Subject', ''))
-        self.content_text = self.get_content_text()
-        self.content_html = self.get_content_html()
-        self.directory = self.get_target_directory(parent_directory)
-        self.file_eml = os.path.join(self.directory, 'message.eml')
-        self.file_json = os.path.join(self.directory, 'message.json')
-        self.file_txt = os.path.join(self.directory, 'message.txt')
-        self.file_html = os.path.join(self.directory, 'message.html')
-        self.file_pdf = os.path.join(self.directory, 'message.pdf')
+        self.message_id = (self.msg.get('Message-Id') or '').strip() or None
+        self.directory = self.get_target_directory(parent_directory, shard)
+        # the DirectoryListing of the archive saves a stat per message
+        self.listing = listing
+        self.exists = listing.exists(self.directory) if listing is not None else os.path.exists(self.directory)
 
-    def get_target_directory(self, parent_directory):
+    def get_target_directory(self, parent_directory, shard=False):
         local_date = datetime.datetime.fromtimestamp(email.utils.mktime_tz(email.utils.parsedate_tz(self.msg["Date"])))
         timestamp = local_date.strftime('%Y%m%d%H%M%S')
         year = local_date.strftime('%Y')
         from_ = self.from_[0] if self.from_[0] != '' else self.from_[1]
-        directory = os.path.join(parent_directory, year, timestamp+"_"+re.sub('[^\\w_\\d.\\-]', '', from_.replace('@', '_at_').replace(' ', '_')))
-        directory = unidecode.unidecode(directory.strip())
-        if not os.path.exists(directory):
-            self.exists = False
-            os.makedirs(directory)
-        return directory
+        name = timestamp+"_"+re.sub('[^\\w_\\d.\\-]', '', from_.replace('@', '_at_').replace(' ', '_'))
+        if shard:
+            # at most 256 subfolders per year, named like the blobs
+            year = os.path.join(year, hashlib.sha1(unidecode.unidecode(name.strip()).encode()).hexdigest()[:2])
+        directory = os.path.join(parent_directory, year, name)
+        return unidecode.unidecode(directory.strip())
 
     def get_header(self, header_text):
         """Decode header_text if needed"""
@@ -120,6 +125,98 @@ class Message:
                 addrs[i] = (self.get_header(name), addr.decode("utf-8"))
         return addrs
 
+
+class Message(MessageHeaders):
+    """Operation on a message"""
+
+    def __init__(self, raw, parent_directory, files=None, listing=None, shard=False, partial=False):
+        start = time.perf_counter()
+        self.spool_directory = None
+        if isinstance(raw, SpooledLiteral):
+            # large message on disk, only parse it without the bodies of its attachments
+            self.spool_directory = os.path.dirname(raw.path)
+            super().__init__(raw.split(), parent_directory, listing, shard)
+        else:
+            super().__init__(raw, parent_directory, listing, shard)
+        self.raw = raw
+        # assembled by the partial fetch, only then its OMITTED_HEADER parts were left on the server
+        self.partial = partial
+        # the create_file_* methods append (name, content) to files, they are
+        # written by write_message or appended to a PackStore
+        self.files = files if files is not None else []
+        # attachment file name -> hash, when stored in a BlobStore
+        self.blobs = {}
+        self.blob_store = None
+        # part -> charset, detected at most once per part
+        self.charsets = {}
+        self.file_eml = os.path.join(self.directory, 'message.eml')
+        self.file_json = os.path.join(self.directory, 'message.json')
+        self.file_txt = os.path.join(self.directory, 'message.txt')
+        self.file_html = os.path.join(self.directory, 'message.html')
+        self.file_pdf = os.path.join(self.directory, 'message.pdf')
+        # step -> seconds spent on it, for the metrics of the run
+        self.timings = {'parse': time.perf_counter() - start}
+
+    # the content of the message is only parsed when an output needs it
+
+    @cached_property
+    def parts(self):
+        return self.get_parts()
+
+    @cached_property
+    def tos(self):
+        return self.get_addresses('to')
+
+    @cached_property
+    def ccs(self):
+        return self.get_addresses('cc')
+
+    @cached_property
+    def subject(self):
+        return self.get_header(self.msg.get('Subject', ''))
+
+    @cached_property
+    def content_text(self):
+        return self.get_content_text()
+
+    @cached_property
+    def content_html(self):
+        return self.get_content_html()
+
+    @cached_property
+    def metadata(self):
+        return self.get_metadata()
+
+    def create_files(self, with_json=True, blob_store=None):
+        """Create the enabled files of the message"""
+        self.timed('parse', lambda: self.parts)
+        self.timed('create_file_raw', self.create_file_raw)
+        self.timed('create_file_text', self.create_file_text)
+        self.timed('create_file_attachments', self.create_file_attachments, blob_store)
+        self.timed('create_file_html', self.create_file_html)
+        if with_json:
+            self.timed('create_file_json', self.create_file_json)
+
+    def timed(self, step, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.timings[step] = self.timings.get(step, 0) + time.perf_counter() - start
+
+    def get_index_key(self):
+        """Message-Id, or a hash of the raw message if it has none"""
+        if self.message_id:
+            return self.message_id
+        digest = hashlib.sha256()
+        if isinstance(self.raw, SpooledLiteral):
+            with open(self.raw.path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                    digest.update(chunk)
+        else:
+            digest.update(self.raw)
+        return 'sha256:' + digest.hexdigest()
+
     def normalize_date(self, datestr):
         if not datestr:
             print("No date for '%s'. Using Unix Epoch instead." % self.directory)
@@ -133,81 +230,87 @@ class Message:
 
         return rfc2822, iso8601
 
-    def create_file_json(self):
-
-        parts = self.get_parts()
+    def get_metadata(self):
+        """The properties of message.json, also used by the catalog"""
         attachments = []
-        for afile in parts['files']:
+        for afile in self.parts['files']:
             attachments.append(afile[1])
 
         rfc2822, iso8601 = self.normalize_date(self.msg['Date'])
 
-        with io.open(self.file_json, 'w', encoding='utf8') as json_file:
-            data = json.dumps({
-                'Id': self.msg['Message-Id'],
-                'Subject': self.subject,
-                'From': self.from_,
-                'To': self.tos,
-                'Cc': self.ccs,
-                'Date': rfc2822,
-                'Utc': iso8601,
-                'Attachments': attachments,
-                'WithHtml': len(self.content_html) > 0,
-                'WithText': len(self.content_text) > 0,
-                'Body': self.content_text
-            }, indent=4, ensure_ascii=False)
-
-            json_file.write(data)
-
-            json_file.close()
+        metadata = {
+            'Id': self.msg['Message-Id'],
+            'Subject': self.subject,
+            'From': self.from_,
+            'To': self.tos,
+            'Cc': self.ccs,
+            'Date': rfc2822,
+            'Utc': iso8601,
+            'Attachments': attachments,
+            'WithHtml': len(self.content_html) > 0,
+            'WithText': len(self.content_text) > 0,
+            'Body': self.content_text
+        }
+        if self.blobs:
+            metadata['Blobs'] = self.blobs
+        if self.parts['omitted']:
+            metadata['Omitted'] = [self.get_omitted(part) for part in self.parts['omitted']]
+        return metadata
+
+    def get_omitted(self, part):
+        """Properties of a part left on the server, from its OMITTED_HEADER"""
+        params = dict(item.strip().split('=', 1) for item in str(part[OMITTED_HEADER]).split(';') if '=' in item)
+        return {
+            'Name': part.get_filename(),
+            'ContentType': part.get_content_type(),
+            'Size': int(params['size']) if params.get('size', '').isdigit() else None,
+            'Section': params.get('section')
+        }
+
+    def create_file_json(self):
+        data = json.dumps(self.metadata, indent=4, ensure_ascii=False)
+
+        self.write_file('message.json', data.encode('utf8'))
 
     def create_file_raw(self):
-        f = open(self.file_eml, 'wb')
-        f.write(self.raw)
-        f.close()
+        self.write_file('message.eml', self.raw)
+        if self.partial:
+            self.write_file(PARTIAL_FILE, b'')
 
-    def get_part_charset(self, part):
-        if part.get_content_charset() is None:
-            try:
-                return chardet.detect(part.as_bytes())['encoding']
-            except UnicodeEncodeError:
-                string = part.as_string()
-                array = bytearray(string, 'utf-8')
-                return chardet.detect(array)['encoding']
-        return part.get_content_charset()
+    def write_file(self, name, content):
+        self.files.append((name, content))
+
+    def get_part_charset(self, part, payload):
+        if part.get_content_charset() is not None:
+            return part.get_content_charset()
+        if id(part) not in self.charsets:
+            # a prefix is enough to guess the charset of the whole payload
+            self.charsets[id(part)] = chardet.detect(payload[:CHARSET_SAMPLE_SIZE])['encoding'] or 'utf-8'
+        return self.charsets[id(part)]
+
+    def decode_part(self, part):
+        payload = part.get_payload(decode=True)
+        return payload.decode(self.get_part_charset(part, payload), "replace")
 
     def get_content_text(self):
         text_content = ''
         for part in self.parts['text']:
-            text_content += part.get_payload(decode=True).decode(self.get_part_charset(part), "replace")
+            text_content += self.decode_part(part)
         return text_content
 
     def create_file_text(self):
         if self.content_text != '':
-            with open(self.file_txt, 'wb') as fp:
-                fp.write(bytearray(self.content_text, 'utf-8'))
+            self.write_file('message.txt', bytearray(self.content_text, 'utf-8'))
 
     def get_content_html(self):
-        html_content = ''
-
-        for part in self.parts['html']:
-            html_content += part.get_payload(decode=True).decode(self.get_part_charset(part), "replace")
-
-        m = re.search('<body[^>]*>(.+)</body>', html_content, re.S | re.I)
-        if m is not None:
-            html_content = m.group(1)
-
-        return html_content
+        html_content = ''.join(self.decode_part(part) for part in self.parts['html'])
+        return extract_html_body(html_content)
 
     def create_file_html(self):
         if self.content_html == '' and self.content_text != '':
             self.content_html = '<br />'.join(self.content_text.splitlines())
         if self.content_html != '':
-            utf8_content = self.content_html
-            for img in self.parts['embed_images']:
-                pattern = 'src=["\']cid:%s["\']' % (re.escape(img[0]))
-                path = os.path.join('attachments', img[1])
-                utf8_content = re.sub(pattern, 'src="%s"' % path, utf8_content, 0, re.S | re.I)
+            utf8_content = self.replace_cid_links(self.content_html)
 
             subject = self.subject
             fromname = self.from_[0]
@@ -224,8 +327,20 @@ class Message:
 </body>
 </html>""" % (html.escape(fromname), html.escape(subject), utf8_content)
 
-            with open(self.file_html, 'wb') as fp:
-                fp.write(bytearray(utf8_content, 'utf-8'))
+            self.write_file('message.html', bytearray(utf8_content, 'utf-8'))
+
+    def replace_cid_links(self, html_content):
+        """Point the src="cid:..." of embedded images to their attachments, in a single scan"""
+        if not self.parts['embed_images']:
+            return html_content
+        links = {}
+        for content_id, filename in self.parts['embed_images']:
+            links.setdefault(content_id.lower(), 'src="%s"' % self.get_attachment_link(filename))
+
+        def replace(m):
+            return links.get(m.group(1).lower(), m.group(0))
+
+        return cid_src_re.sub(replace, html_content)
 
     def sanitize_filename(self, filename):
         keepcharacters = (' ', '.', '_', '-')
@@ -237,14 +352,21 @@ class Message:
             'text': [],
             'html': [],
             'embed_images': [],
-            'files': []
+            'files': [],
+            'omitted': []
         }
+        partial = self.partial and self.msg.get(PARTIAL_HEADER) is not None
 
         for part in self.msg.walk():
             # multipart/* are just containers
             if part.get_content_maintype() == 'multipart':
                 continue
 
+            if partial and part.get(OMITTED_HEADER) is not None:
+                # left on the server by the partial fetch, only its header was archived
+                message_parts['omitted'].append(part)
+                continue
+
             # Applications should really sanitize the given filename so that an
             # email message can't be used to overwrite important files
             filename = part.get_filename()
@@ -275,45 +397,116 @@ class Message:
 
         return message_parts
 
-    def create_file_attachments(self):
-        if self.parts['files']:
-            attdir = os.path.join(self.directory, 'attachments')
-            if not os.path.exists(attdir):
-                os.makedirs(attdir)
-            else:
-                return False
-            for afile in self.parts['files']:
-                payload = afile[0].get_payload(decode=True)
-                if payload:
-                    with open(os.path.join(attdir, afile[1]), 'wb') as fp:
-                        fp.write(payload)
-                        fp.close()
-
-    def create_file_pdf(self, wkhtmltopdf):
-        if has_pdfkit:
-            pdfkit_options = {
-                'quiet': '',
-                'disable-javascript': '',
-                'enable-local-file-access': '',
-                'encoding': 'utf-8',
-            }
-            config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf)
-            if os.path.exists(self.file_html):
+    def get_attachment_link(self, filename):
+        """Relative link from message.html to an attachment"""
+        if self.blob_store is not None and self.blob_store.mode == 'reference' and filename in self.blobs:
+            return os.path.relpath(self.blob_store.path(self.blobs[filename]), self.directory)
+        return os.path.join('attachments', filename)
+
+    def create_file_attachments(self, blob_store=None):
+        """Write the attachments, into blob_store if given (to call before create_file_html and create_file_json)"""
+        self.blob_store = blob_store
+        for afile in self.parts['files']:
+            payload = get_spooled_payload(afile[0], self.spool_directory) or afile[0].get_payload(decode=True)
+            if payload:
+                if blob_store is not None:
+                    payload = blob_store.blob(payload)
+                    self.blobs[afile[1]] = payload.digest
+                self.write_file(os.path.join('attachments', afile[1]), payload)
+
+
+def extract_html_body(html_content):
+    """Content of the <body> element, or the whole html if there is none"""
+    start = body_start_re.search(html_content)
+    if start is None:
+        return html_content
+    end = None
+    for end in body_end_re.finditer(html_content, start.end() + 1):
+        pass
+    if end is None:
+        return html_content
+    return html_content[start.end():end.start()]
+
+
+# saving a message that can't be parsed, it fails the same way each time it is fetched
+UNREADABLE = 'unreadable'
+
+
+def write_message(directory, files, staging_directory, listing=None):
+    """Write the (name, content) files of a new message into directory, False if it already exists
+
+    The files are written into a staging directory moved to directory once complete, so an
+    interrupted write never leaves a half written message in the archive.
+    """
+    if listing.exists(directory) if listing is not None else os.path.exists(directory):
+        return False
+    staging = os.path.join(staging_directory, uuid.uuid4().hex)
+    os.makedirs(staging)
+    try:
+        for name, content in files:
+            write_file(os.path.join(staging, name), content)
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        try:
+            os.rename(staging, directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+            # archived in the meantime by another worker
+            return False
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    if listing is not None:
+        listing.add(directory)
+    return True
+
+
+def write_file(path, content):
+    """Write bytes, a spooled content or a Blob to path"""
+    if isinstance(content, Blob):
+        content.save(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        write_content(fp, content)
+
+
+def write_content(fp, content):
+    """Write bytes or a spooled content (SpooledLiteral, SpooledPayload) to fp"""
+    if isinstance(content, (bytes, bytearray)):
+        fp.write(content)
+    else:
+        content.write_to(fp)
+
+
+def create_file_pdf(directory, wkhtmltopdf):
+    """Render message.pdf from the message.html (or message.txt) of an archive directory"""
+    file_html = os.path.join(directory, 'message.html')
+    file_txt = os.path.join(directory, 'message.txt')
+    file_pdf = os.path.join(directory, 'message.pdf')
+    if has_pdfkit:
+        pdfkit_options = {
+            'quiet': '',
+            'disable-javascript': '',
+            'enable-local-file-access': '',
+            'encoding': 'utf-8',
+        }
+        config = pdfkit.configuration(wkhtmltopdf=wkhtmltopdf)
+        if os.path.exists(file_html):
+            try:
+                pdfkit.from_file(file_html, file_pdf, options=pdfkit_options, configuration=config)
+            except Exception as e:
+                print('pdfkit: ')
+                print(e)
+
+        else:
+            print("Couldn't create PDF message from html")
+            if os.path.exists(file_txt):
                 try:
-                    pdfkit.from_file(self.file_html, self.file_pdf, options=pdfkit_options, configuration=config)
+                    pdfkit.from_file(file_txt, file_pdf, options=pdfkit_options, configuration=config)
                 except Exception as e:
                     print('pdfkit: ')
                     print(e)
-
             else:
-                print("Couldn't create PDF message from html")
-                if os.path.exists(self.file_txt):
-                    try:
-                        pdfkit.from_file(self.file_txt, self.file_pdf, options=pdfkit_options, configuration=config)
-                    except Exception as e:
-                        print('pdfkit: ')
-                        print(e)
-                else:
-                    print("Couldn't create PDF message from txt")
-        else:
-            print("Couldn't create PDF message, since \"pdfkit\" module isn't installed.")
+                print("Couldn't create PDF message from txt")
+    else:
+        print("Couldn't create PDF message, since \"pdfkit\" module isn't installed.")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+
+
+class MessageIndex:
+    """SQLite index of the archived messages by Message-Id and folder root, shared by all accounts
+
+    The root is the local folder a message is archived in: local_folder itself, or the local
+    subfolder of its remote folder with local_subfolder, where each remote folder keeps its own
+    copy of the messages.
+    """
+
+    def __init__(self, local_folder):
+        self.local_folder = local_folder
+        self.file = os.path.join(local_folder, '.imapbox', 'index.sqlite')
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.file, check_same_thread=False, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(messages)')]
+        if columns and 'root' not in columns:
+            # keyed by Message-Id alone before, the archived messages are indexed again as they are met
+            self.connection.execute('DROP TABLE messages')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS messages (message_id TEXT NOT NULL, root TEXT NOT NULL, directory TEXT NOT NULL, '
+                                'source TEXT, PRIMARY KEY (message_id, root))')
+        self.connection.commit()
+
+    def relative(self, path):
+        return os.path.relpath(path, self.local_folder)
+
+    def get(self, message_id, root=None):
+        """Return the archive directory of a Message-Id in the folder root, or in any folder without root, or None"""
+        if not message_id:
+            return None
+        with self.lock:
+            if root is None:
+                row = self.connection.execute('SELECT directory FROM messages WHERE message_id = ?', (message_id,)).fetchone()
+            else:
+                row = self.connection.execute('SELECT directory FROM messages WHERE message_id = ? AND root = ?', (message_id, self.relative(root))).fetchone()
+        return os.path.join(self.local_folder, row[0]) if row else None
+
+    def get_source(self, message_id, root):
+        """Return the account/folder a Message-Id of the folder root was archived from, or None if unknown"""
+        if not message_id:
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT source FROM messages WHERE message_id = ? AND root = ?', (message_id, self.relative(root))).fetchone()
+        return row[0] if row else None
+
+    def add(self, message_id, root, directory, source=None):
+        if not message_id:
+            return
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO messages (message_id, root, directory, source) VALUES (?, ?, ?, ?)',
+                                    (message_id, self.relative(root), self.relative(directory), source))
+
+    def remove(self, message_id, root):
+        if not message_id:
+            return
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM messages WHERE message_id = ? AND root = ?', (message_id, self.relative(root)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
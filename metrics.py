@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+COUNTERS = {
+    'messages_found': 'Messages found by the search',
+    'messages_skipped': 'Messages already archived, skipped after fetching their headers',
+    'messages_fetched': 'Messages downloaded',
+    'messages_created': 'Messages written to the archive',
+    'messages_existing': 'Messages found already archived',
+    'messages_failed': 'Messages that could not be saved',
+    'bytes_fetched': 'Size of the downloaded messages',
+    'bytes_skipped': 'Size of the messages not downloaded because they are already archived',
+    'attachments_omitted': 'Message parts above max_attachment_size left on the server',
+    'bytes_omitted': 'Size of the message parts left on the server',
+    'folders_unchanged': 'Folders not exported because their STATUS did not change',
+    'pdf_rendered': 'message.pdf files rendered',
+    'pdf_failed': 'message.pdf files that could not be rendered',
+}
+
+
+class Metrics:
+    """Time spent in each stage of a run and counters, per account folder
+
+    Folders are identified by a (account name, remote folder) key, a None key is used
+    for the work of the run that belongs to no folder, like the PDF rendering.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.folders = {}
+
+    def get_folder(self, key):
+        if key not in self.folders:
+            self.folders[key] = {'duration': 0, 'stages': {}, 'counters': {}}
+        return self.folders[key]
+
+    def add(self, key, stage, seconds):
+        with self.lock:
+            stages = self.get_folder(key)['stages']
+            stages[stage] = stages.get(stage, 0) + seconds
+
+    def add_timings(self, key, timings):
+        for stage, seconds in timings.items():
+            self.add(key, stage, seconds)
+
+    def count(self, key, name, value=1):
+        with self.lock:
+            counters = self.get_folder(key)['counters']
+            counters[name] = counters.get(name, 0) + value
+
+    def add_duration(self, key, seconds):
+        with self.lock:
+            self.get_folder(key)['duration'] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, key, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(key, stage, time.perf_counter() - start)
+
+    def report(self):
+        with self.lock:
+            run = self.folders.get(None, {'stages': {}, 'counters': {}})
+            return {
+                'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+                'duration': time.time() - self.started,
+                'stages': dict(run['stages']),
+                'counters': dict(run['counters']),
+                'folders': [
+                    {'account': key[0], 'folder': key[1], 'duration': folder['duration'],
+                     'stages': dict(folder['stages']), 'counters': dict(folder['counters'])}
+                    for key, folder in self.folders.items() if key is not None
+                ],
+            }
+
+    def write(self):
+        """Write the report to the metrics file, in the Prometheus text format if its name ends with .prom"""
+        if not self.file:
+            return
+        report = self.report()
+        content = prometheus_text(report, self.started) if self.file.endswith('.prom') else json.dumps(report, indent=4, ensure_ascii=False)
+        directory = os.path.dirname(os.path.abspath(self.file))
+        os.makedirs(directory, exist_ok=True)
+        # the textfile collector must never read a partial file
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as fp:
+            fp.write(content)
+        os.replace(tmp_file, self.file)
+
+
+def prometheus_labels(labels):
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+
+def prometheus_text(report, started):
+    lines = [
+        '# HELP imapbox_run_timestamp_seconds Start time of the last imapbox run',
+        '# TYPE imapbox_run_timestamp_seconds gauge',
+        'imapbox_run_timestamp_seconds {}'.format(started),
+        '# HELP imapbox_run_duration_seconds Duration of the last imapbox run',
+        '# TYPE imapbox_run_duration_seconds gauge',
+        'imapbox_run_duration_seconds {}'.format(report['duration']),
+        '# HELP imapbox_folder_duration_seconds Duration of the export of a folder',
+        '# TYPE imapbox_folder_duration_seconds gauge',
+    ]
+    for folder in report['folders']:
+        labels = {'account': folder['account'], 'folder': folder['folder']}
+        lines.append('imapbox_folder_duration_seconds{} {}'.format(prometheus_labels(labels), folder['duration']))
+
+    lines.append('# HELP imapbox_stage_seconds Time spent in each stage, summed over the threads and processes')
+    lines.append('# TYPE imapbox_stage_seconds gauge')
+    for stage, seconds in sorted(report['stages'].items()):
+        lines.append('imapbox_stage_seconds{} {}'.format(prometheus_labels({'stage': stage}), seconds))
+    for folder in report['folders']:
+        for stage, seconds in sorted(folder['stages'].items()):
+            labels = {'account': folder['account'], 'folder': folder['folder'], 'stage': stage}
+            lines.append('imapbox_stage_seconds{} {}'.format(prometheus_labels(labels), seconds))
+
+    for name, description in COUNTERS.items():
+        values = []
+        if name in report['counters']:
+            values.append(('', report['counters'][name]))
+        for folder in report['folders']:
+            if name in folder['counters']:
+                labels = {'account': folder['account'], 'folder': folder['folder']}
+                values.append((prometheus_labels(labels), folder['counters'][name]))
+        if not values:
+            continue
+        lines.append('# HELP imapbox_{} {}'.format(name, description))
+        lines.append('# TYPE imapbox_{} gauge'.format(name))
+        for labels, value in values:
+            lines.append('imapbox_{}{} {}'.format(name, labels, value))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import lzma
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import zlib
+
+from blobstore import Blob
+
+MAGIC = b'IMAPBOX1'
+CHUNK_SIZE = 64 * 1024
+
+COMPRESSORS = {
+    'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj),
+    'lzma': (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+
+
+class RecordWriter:
+    """File-like sink compressing what is written into a segment"""
+
+    def __init__(self, fp, compression):
+        self.fp = fp
+        self.compressor = COMPRESSORS[compression][0]() if compression else None
+        self.length = 0
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.fp.write(data)
+        self.length += len(data)
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.fp.write(data)
+            self.length += len(data)
+
+
+class PackStore:
+    """Archive files appended to segment files instead of one file each
+
+    Each file of a message is a record of a segment in local_folder/.imapbox/packs: a header
+    (MAGIC, directory and name as JSON) and the optionally compressed content. An index in
+    packs/index.sqlite locates the records. The segments are synced and the index committed
+    every sync_interval messages, the Message-Ids of these messages are added to the message
+    index only then, so a message is never marked archived before it is on disk.
+    """
+
+    def __init__(self, local_folder, compression='zlib', segment_size=1024 * 1024 * 1024, sync_interval=100, message_index=None):
+        self.local_folder = local_folder
+        self.directory = os.path.join(local_folder, '.imapbox', 'packs')
+        self.compression = compression or None
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.message_index = message_index
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), check_same_thread=False, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (directory TEXT NOT NULL, name TEXT NOT NULL, segment INTEGER NOT NULL, '
+                                'offset INTEGER NOT NULL, length INTEGER NOT NULL, compression TEXT, blob TEXT, PRIMARY KEY (directory, name))')
+        self.connection.commit()
+        self.segment = None
+        self.fp = None
+        # (index key, folder root, directory) of the messages written since the last sync
+        self.pending = []
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'segment-{:06d}.pack'.format(segment))
+
+    def segments(self):
+        return sorted(int(name[8:14]) for name in os.listdir(self.directory) if name.startswith('segment-') and name.endswith('.pack'))
+
+    def open_segment(self):
+        """The segment to append to, a new one when the current is full"""
+        if self.fp is not None and self.fp.tell() < self.segment_size:
+            return self.fp
+        if self.fp is not None:
+            self.sync()
+            self.fp.close()
+            self.segment += 1
+        else:
+            segments = self.segments()
+            self.segment = segments[-1] if segments else 1
+        path = self.segment_path(self.segment)
+        if os.path.exists(path) and os.path.getsize(path) != self.indexed_size(self.segment):
+            # ends with the record of an interrupted run, keep it readable by reindex()
+            self.segment += 1
+            path = self.segment_path(self.segment)
+        self.fp = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self.fp.seek(0, os.SEEK_END)
+        if self.fp.tell() >= self.segment_size:
+            return self.open_segment()
+        return self.fp
+
+    def indexed_size(self, segment):
+        """End of the last indexed record of a segment"""
+        row = self.connection.execute('SELECT MAX(offset + length) FROM files WHERE segment = ?', (segment,)).fetchone()
+        return row[0] or 0
+
+    def relative(self, directory):
+        return os.path.relpath(directory, self.local_folder)
+
+    def contains(self, directory):
+        """True if a message directory is archived, or being archived"""
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM files WHERE directory = ? LIMIT 1', (self.relative(directory),)).fetchone() is not None
+
+    def add(self, directory, files, index_key=None, root=None):
+        """Append the (name, content) files of a message, False if it is already archived
+
+        index_key is added to the message index with the folder root once the message is synced.
+        """
+        directory = self.relative(directory)
+        with self.lock:
+            if self.connection.execute('SELECT 1 FROM files WHERE directory = ? LIMIT 1', (directory,)).fetchone():
+                return False
+            # all the files of a message in one segment, a failed add leaves neither rows nor records
+            fp = self.open_segment()
+            end = fp.tell()
+            if not self.connection.in_transaction:
+                self.connection.execute('BEGIN')
+            self.connection.execute('SAVEPOINT add_message')
+            try:
+                for name, content in files:
+                    self.add_file(fp, directory, name, content)
+            except BaseException:
+                self.connection.execute('ROLLBACK TO add_message')
+                self.connection.execute('RELEASE add_message')
+                fp.truncate(end)
+                fp.seek(end)
+                raise
+            self.connection.execute('RELEASE add_message')
+            self.pending.append((index_key, root, directory))
+            if len(self.pending) >= self.sync_interval:
+                self.sync()
+        return True
+
+    def add_file(self, fp, directory, name, content):
+        blob = None
+        compression = self.compression
+        if isinstance(content, Blob):
+            # the content is in the blob store
+            content.store.put(content)
+            blob = content.digest
+            compression = None
+        header = json.dumps({'directory': directory, 'name': name, 'compression': compression, 'blob': blob}).encode('utf8')
+        fp.write(MAGIC + struct.pack('>I', len(header)) + header)
+        length_offset = fp.tell()
+        fp.write(struct.pack('>Q', 0))
+        offset = fp.tell()
+        writer = RecordWriter(fp, compression)
+        if blob is None:
+            if isinstance(content, (bytes, bytearray)):
+                writer.write(content)
+            else:
+                content.write_to(writer)
+        writer.close()
+        fp.seek(length_offset)
+        fp.write(struct.pack('>Q', writer.length))
+        fp.seek(0, os.SEEK_END)
+        self.connection.execute('INSERT OR REPLACE INTO files (directory, name, segment, offset, length, compression, blob) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (directory, name, self.segment, offset, writer.length, compression, blob))
+
+    def sync(self):
+        """Make the written messages durable, then mark them archived in the message index"""
+        with self.lock:
+            if self.fp is not None:
+                self.fp.flush()
+                os.fsync(self.fp.fileno())
+            self.connection.commit()
+            if self.message_index is not None:
+                for index_key, root, directory in self.pending:
+                    self.message_index.add(index_key, root or self.local_folder, os.path.join(self.local_folder, directory))
+            self.pending = []
+
+    def directories(self, prefix=''):
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT directory FROM files WHERE directory >= ? AND directory < ? ORDER BY directory',
+                                           (prefix, prefix + '\U0010ffff')).fetchall()
+        return [row[0] for row in rows]
+
+    def copy_file(self, directory, name, fp):
+        """Write the content of a file of a message to fp, False if there is no such file"""
+        with self.lock:
+            row = self.connection.execute('SELECT segment, offset, length, compression, blob FROM files WHERE directory = ? AND name = ?',
+                                          (directory, name)).fetchone()
+            if self.fp is not None:
+                self.fp.flush()
+        if row is None:
+            return False
+        segment, offset, length, compression, blob = row
+        if blob is not None:
+            return False
+        decompressor = COMPRESSORS[compression][1]() if compression else None
+        with open(self.segment_path(segment), 'rb') as src:
+            src.seek(offset)
+            while length:
+                data = src.read(min(length, CHUNK_SIZE))
+                if not data:
+                    raise IOError('truncated pack segment {}'.format(segment))
+                length -= len(data)
+                fp.write(decompressor.decompress(data) if decompressor is not None else data)
+        return True
+
+    def read_file(self, directory, name):
+        fp = io.BytesIO()
+        if not self.copy_file(directory, name, fp):
+            return None
+        return fp.getvalue()
+
+    def extract(self, target, prefix='', blob_store=None):
+        """Write the messages under prefix into target with the classic folder layout, return their number
+
+        The attachments of the blob store are linked with its 'hardlink' mode, only referenced
+        by message.json with 'reference'. Without the blob store they are skipped and listed.
+        """
+        count = 0
+        referenced = 0
+        for directory in self.directories(prefix):
+            message_directory = os.path.join(target, directory)
+            if os.path.exists(message_directory):
+                continue
+            with self.lock:
+                rows = self.connection.execute('SELECT name, blob FROM files WHERE directory = ?', (directory,)).fetchall()
+            for name, blob in rows:
+                path = os.path.join(message_directory, name)
+                if blob is not None:
+                    if blob_store is None:
+                        print("Skipped {}: its content is in the blob store and attachment_store is not set".format(os.path.join(directory, name)))
+                    elif blob_store.mode == 'hardlink':
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        try:
+                            os.link(blob_store.path(blob), path)
+                        except OSError:
+                            shutil.copyfile(blob_store.path(blob), path)
+                    else:
+                        referenced += 1
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as fp:
+                    self.copy_file(directory, name, fp)
+            count += 1
+        if referenced:
+            print('{} attachments not extracted, they are referenced by the Blobs of message.json (attachment_store = {})'.format(referenced, blob_store.mode))
+        return count
+
+    def reindex(self):
+        """Rebuild the index from the record headers of the segments, return the number of files"""
+        count = 0
+        with self.lock:
+            self.connection.execute('DELETE FROM files')
+            for segment in self.segments():
+                with open(self.segment_path(segment), 'rb') as fp:
+                    while True:
+                        start = fp.read(len(MAGIC) + 4)
+                        if len(start) < len(MAGIC) + 4 or not start.startswith(MAGIC):
+                            break
+                        header = fp.read(struct.unpack('>I', start[len(MAGIC):])[0])
+                        size = fp.read(8)
+                        if len(size) < 8:
+                            break
+                        length = struct.unpack('>Q', size)[0]
+                        offset = fp.tell()
+                        if offset + length > os.fstat(fp.fileno()).st_size:
+                            # interrupted write
+                            break
+                        header = json.loads(header.decode('utf8'))
+                        self.connection.execute('INSERT OR REPLACE INTO files (directory, name, segment, offset, length, compression, blob) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                                (header['directory'], header['name'], segment, offset, length, header['compression'], header['blob']))
+                        fp.seek(length, os.SEEK_CUR)
+                        count += 1
+            self.connection.commit()
+        return count
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            self.connection.close()
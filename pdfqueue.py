@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from message import create_file_pdf
+
+
+class PdfQueue:
+    """Renders message.pdf files in the background, pending directories survive restarts"""
+
+    def __init__(self, local_folder, wkhtmltopdf, workers, metrics=None):
+        self.local_folder = local_folder
+        self.metrics = metrics
+        self.file = os.path.join(local_folder, '.imapbox', 'pdf-backlog.txt')
+        self.wkhtmltopdf = wkhtmltopdf
+        self.lock = threading.Lock()
+        self.pending = set()
+        # of the backlog file, rewritten with the pending directories once they are less than half
+        self.lines = 0
+        # each worker thread drives one wkhtmltopdf process
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        for directory in self.load():
+            self.lines += 1
+            if directory not in self.pending:
+                self.pending.add(directory)
+                self.executor.submit(self.render, directory)
+
+    def load(self):
+        if not os.path.exists(self.file):
+            return []
+        with open(self.file, 'r', encoding='utf8') as fp:
+            return [line.rstrip('\n') for line in fp if line.strip()]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as fp:
+            for directory in sorted(self.pending):
+                fp.write(directory + '\n')
+        os.replace(tmp_file, self.file)
+        self.lines = len(self.pending)
+
+    def put(self, directory):
+        directory = os.path.abspath(directory)
+        with self.lock:
+            if directory in self.pending:
+                return
+            self.pending.add(directory)
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            with open(self.file, 'a', encoding='utf8') as fp:
+                fp.write(directory + '\n')
+            self.lines += 1
+        self.executor.submit(self.render, directory)
+
+    def render(self, directory):
+        try:
+            file_pdf = os.path.join(directory, 'message.pdf')
+            if os.path.isdir(directory) and not os.path.exists(file_pdf):
+                start = time.perf_counter()
+                create_file_pdf(directory, self.wkhtmltopdf)
+                if self.metrics is not None:
+                    self.metrics.add(None, 'pdf', time.perf_counter() - start)
+                    self.metrics.count(None, 'pdf_rendered' if os.path.exists(file_pdf) else 'pdf_failed')
+        finally:
+            with self.lock:
+                self.pending.discard(directory)
+                # the daemon never joins the queue
+                if self.lines > 2 * len(self.pending):
+                    self.save()
+
+    def put_missing(self):
+        """Queue every archived message without a message.pdf"""
+        count = 0
+        for root, dirs, files in os.walk(self.local_folder):
+            dirs[:] = [d for d in dirs if d not in ('.imapbox', 'attachments')]
+            if 'message.eml' in files and 'message.pdf' not in files:
+                self.put(root)
+                count += 1
+        return count
+
+    def join(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.save()
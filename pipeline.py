@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+
+from message import UNREADABLE, Message, write_message
+from metrics import Metrics
+from spool import SpooledLiteral
+
+
+def create_process_pool(processes):
+    # spawn: forking a process with running IMAP threads is not safe
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+def render_message(raw, local_folder, with_json, blob_store=None, shard=False, partial=False):
+    """Parse a message and render its files in memory, runs in a worker process"""
+    files = []
+    message = Message(raw, local_folder, files, shard=shard, partial=partial)
+    if message.exists:
+        return message.directory, message.message_id, None, None, message.timings
+    message.create_files(with_json, blob_store)
+    return message.directory, message.get_index_key(), files, message.metadata, message.timings
+
+
+class Pipeline:
+    """Fetched messages are parsed on a process pool and written by a writer thread
+
+    The bytes of the messages between the fetch and the write stage are limited
+    to max_bytes, submit() blocks until enough messages have been written.
+    Messages spooled to disk do not count.
+    """
+
+    def __init__(self, executor, options, local_folder, archive=None, metrics_key=None):
+        self.executor = executor
+        self.options = options
+        self.local_folder = local_folder
+        self.pdf_queue = archive.pdf_queue if archive is not None else None
+        self.message_index = archive.message_index if archive is not None else None
+        self.catalog = archive.catalog if archive is not None else None
+        self.pack_store = archive.pack_store if archive is not None else None
+        self.blob_store = archive.blob_store if archive is not None else None
+        self.listing = archive.listing if archive is not None else None
+        self.staging_directory = archive.staging_directory if archive is not None else os.path.abspath(os.path.join(local_folder, '.imapbox', 'staging'))
+        self.metrics = archive.metrics if archive is not None else Metrics()
+        self.metrics_key = metrics_key
+        self.source = '{}/{}'.format(*metrics_key) if metrics_key is not None else None
+        self.max_bytes = options.pipeline_bytes
+        self.in_flight = 0
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.written = queue.Queue()
+        self.results = {}
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def submit(self, uid, raw, partial=False):
+        if raw is None:
+            self.results[uid] = None
+            return
+        size = 0 if isinstance(raw, SpooledLiteral) else len(raw)
+        start = time.perf_counter()
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.max_bytes:
+                self.condition.wait()
+            self.in_flight += size
+            self.pending += 1
+        self.metrics.add(self.metrics_key, 'backpressure', time.perf_counter() - start)
+        future = self.executor.submit(render_message, raw, self.local_folder, self.options.json, self.blob_store,
+                                     self.options.shard_directories, partial)
+        future.add_done_callback(lambda done: self.written.put((uid, raw, size, done)))
+
+    def write(self):
+        while True:
+            item = self.written.get()
+            if item is None:
+                return
+            uid, raw, size, future = item
+            rendered = False
+            try:
+                directory, index_key, files, metadata, timings = future.result()
+                rendered = True
+                self.metrics.add_timings(self.metrics_key, timings)
+                if self.message_index is not None and self.message_index.get(index_key, self.local_folder):
+                    saved = False
+                else:
+                    with self.metrics.timer(self.metrics_key, 'write'):
+                        if files is None:
+                            saved = False
+                        elif self.pack_store is not None:
+                            # added to the message index by the pack store once on disk
+                            saved = self.pack_store.add(directory, files, index_key, self.local_folder)
+                        else:
+                            saved = write_message(directory, files, self.staging_directory, self.listing)
+                if self.message_index is not None and (files is None or saved and self.pack_store is None):
+                    # the source of a message found on disk is not known
+                    self.message_index.add(index_key, self.local_folder, directory, self.source if files is not None else None)
+                if saved and self.catalog is not None:
+                    with self.metrics.timer(self.metrics_key, 'catalog'):
+                        self.catalog.add(directory, metadata)
+                if saved and self.pdf_queue is not None:
+                    self.pdf_queue.put(directory)
+            except Exception as e:
+                print("MailboxClient.saveEmail() failed")
+                print(e)
+                # the errors of the archive and of the workers are retried, not those of the parse
+                saved = UNREADABLE if not rendered and not isinstance(e, (OSError, MemoryError, sqlite3.Error, BrokenExecutor)) else None
+            if isinstance(raw, SpooledLiteral):
+                raw.remove()
+            with self.condition:
+                self.results[uid] = saved
+                self.in_flight -= size
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def join(self):
+        """Wait for all submitted messages and return {uid: True (saved), False (exists), None (failed) or UNREADABLE}"""
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+        self.written.put(None)
+        self.writer.join()
+        return self.results
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from bodystructure import PARTIAL_FILE
+from message import Message, create_file_pdf, write_file
+from spool import SpooledLiteral
+
+# messages submitted to the process pool per process
+PENDING_PER_PROCESS = 4
+
+
+def rebuild_message(directory, with_json, blob_store=None, wkhtmltopdf=None, spool_size=0, spool_directory=None):
+    """Render the files of an archived message again from its message.eml, runs in a worker process"""
+    file_eml = os.path.join(directory, 'message.eml')
+    size = os.path.getsize(file_eml)
+    if spool_size and spool_directory and size >= spool_size:
+        # parsed from disk like a large fetched message, the spool copy is a hard link if possible
+        os.makedirs(spool_directory, exist_ok=True)
+        path = os.path.join(tempfile.mkdtemp(dir=spool_directory), 'message.eml')
+        try:
+            os.link(file_eml, path)
+        except OSError:
+            shutil.copyfile(file_eml, path)
+        raw = SpooledLiteral(path, size)
+    else:
+        with open(file_eml, 'rb') as fp:
+            raw = fp.read()
+    try:
+        files = []
+        message = Message(raw, os.path.dirname(os.path.dirname(directory)), files, partial=os.path.exists(os.path.join(directory, PARTIAL_FILE)))
+        # the archived directory, even if the naming of the directories changed since
+        message.directory = directory
+        message.create_files(with_json, blob_store)
+        for name, content in files:
+            path = os.path.join(directory, name)
+            if name in ('message.eml', PARTIAL_FILE) or (name.startswith('attachments' + os.sep) and os.path.exists(path)):
+                continue
+            # never leave a partial file with a recent mtime
+            write_file(path + '.tmp', content)
+            if os.path.exists(path + '.tmp'):
+                os.replace(path + '.tmp', path)
+        if wkhtmltopdf:
+            create_file_pdf(directory, wkhtmltopdf)
+    finally:
+        if isinstance(raw, SpooledLiteral):
+            raw.remove()
+    return directory
+
+
+class Rebuilder:
+    """Regenerate the files derived from the message.eml of the archived messages, without the IMAP server
+
+    A message is rebuilt when one of its files is missing or older than its message.eml. With
+    rebuild_all, every message is rebuilt. The start of such a rebuild is kept in
+    local_folder/.imapbox/rebuild.json until it completes, so an interrupted rebuild resumes
+    with the messages whose files are older than this start.
+    """
+
+    def __init__(self, options, blob_store=None, rebuild_all=False):
+        self.options = options
+        self.local_folder = options.local_folder
+        self.blob_store = blob_store
+        self.file = os.path.join(options.local_folder, '.imapbox', 'rebuild.json')
+        self.since = self.load() if rebuild_all else 0
+        self.spool_directory = os.path.abspath(os.path.join(options.local_folder, '.imapbox', 'spool'))
+
+    def load(self):
+        if os.path.exists(self.file):
+            try:
+                with open(self.file, 'r', encoding='utf8') as fp:
+                    since = json.load(fp)['since']
+                print('Resuming the rebuild started at {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since))))
+                return since
+            except Exception as e:
+                print("Couldn't read '{}', starting a new rebuild".format(self.file))
+                print(e)
+        since = time.time()
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        with open(self.file, 'w', encoding='utf8') as fp:
+            json.dump({'since': since}, fp)
+        return since
+
+    def walk(self):
+        """Yield the directories of the archived messages"""
+        for root, dirs, files in os.walk(self.local_folder):
+            dirs[:] = [d for d in dirs if d not in ('.imapbox', 'attachments')]
+            if 'message.eml' in files:
+                yield root
+
+    def is_stale(self, directory):
+        required = ['message.json'] if self.options.json else []
+        # rendered from the text or the HTML of the message, a message without both has none
+        with_body = ['message.html']
+        if self.options.wkhtmltopdf:
+            with_body.append('message.pdf')
+        try:
+            oldest = max(os.stat(os.path.join(directory, 'message.eml')).st_mtime, self.since)
+            for name in required + with_body + ['message.txt']:
+                path = os.path.join(directory, name)
+                if not os.path.exists(path):
+                    if name in required or (name in with_body and self.has_body(directory)):
+                        return True
+                elif os.stat(path).st_mtime < oldest:
+                    return True
+        except OSError:
+            return True
+        return False
+
+    def has_body(self, directory):
+        """True if the message has a text or HTML part, as far as its rendered files tell"""
+        if os.path.exists(os.path.join(directory, 'message.txt')):
+            return True
+        try:
+            with open(os.path.join(directory, 'message.json'), 'r', encoding='utf8') as fp:
+                metadata = json.load(fp)
+        except (OSError, ValueError):
+            # without message.json, only the messages with a message.txt are known to have a body
+            return False
+        return bool(metadata.get('WithHtml') or metadata.get('WithText'))
+
+    def run(self, executor, processes):
+        """Rebuild the stale messages on the process pool, return (rebuilt, up to date, failed)"""
+        rebuilt = up_to_date = failed = 0
+        pending = set()
+
+        def collect(futures):
+            nonlocal rebuilt, failed
+            for future in futures:
+                try:
+                    future.result()
+                    rebuilt += 1
+                except Exception as e:
+                    print("Couldn't rebuild {}: {}".format(future.directory, e))
+                    failed += 1
+
+        for directory in self.walk():
+            if not self.is_stale(directory):
+                up_to_date += 1
+                continue
+            if len(pending) >= processes * PENDING_PER_PROCESS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(rebuild_message, directory, self.options.json, self.blob_store, self.options.wkhtmltopdf,
+                                     self.options.spool_size, self.spool_directory)
+            future.directory = directory
+            pending.add(future)
+        collect(wait(pending).done)
+
+        if self.since and not failed:
+            os.remove(self.file)
+        return rebuilt, up_to_date, failed
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import binascii
+import email.parser
+import imaplib
+import os
+import quopri
+import shutil
+import tempfile
+
+from deflate import DeflateMixin
+from idle import IdleMixin
+
+CHUNK_SIZE = 64 * 1024
+
+# bodies of attachments larger than this are kept on disk while parsing a spooled message
+PART_SPOOL_SIZE = 1024 * 1024
+
+SPOOL_HEADER = 'X-Imapbox-Spool'
+
+
+class SpooledLiteral:
+    """A message literal written to a spool directory instead of memory"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def write_to(self, fp):
+        with open(self.path, 'rb') as src:
+            shutil.copyfileobj(src, fp, CHUNK_SIZE)
+
+    def split(self):
+        """Return the message with its large attachment bodies replaced by references to spooled files"""
+        with open(self.path, 'rb') as fp:
+            return split_message(fp, os.path.dirname(self.path))
+
+    def remove(self):
+        shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+
+
+class SpooledPayload:
+    """The encoded body of a part, decoded chunk-wise when written"""
+
+    def __init__(self, path, encoding):
+        self.path = path
+        self.encoding = encoding
+
+    def write_to(self, fp):
+        with open(self.path, 'rb') as src:
+            if self.encoding == 'base64':
+                leftover = b''
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    data = leftover + b''.join(chunk.split())
+                    cut = len(data) - len(data) % 4
+                    leftover = data[cut:]
+                    try:
+                        fp.write(binascii.a2b_base64(data[:cut]))
+                    except binascii.Error:
+                        # same leniency as email: skip broken data
+                        pass
+            elif self.encoding == 'quoted-printable':
+                quopri.decode(src, fp)
+            else:
+                shutil.copyfileobj(src, fp, CHUNK_SIZE)
+
+
+def get_spooled_payload(part, spool_directory):
+    """SpooledPayload of a part whose body was left on disk by split_message(), or None"""
+    path = part.get(SPOOL_HEADER)
+    # never trust the header outside of the spool directory of the message
+    if not path or not spool_directory or os.path.dirname(path) != spool_directory:
+        return None
+    return SpooledPayload(path, part.get('Content-Transfer-Encoding', '7bit').strip().lower())
+
+
+def create_spool_path(spool_directory):
+    """Path of a new message.eml, in its own folder of spool_directory"""
+    os.makedirs(spool_directory, exist_ok=True)
+    return os.path.join(tempfile.mkdtemp(dir=spool_directory), 'message.eml')
+
+
+class SpoolingMixin:
+    """imaplib connection writing literals above spool_size straight into spool_directory"""
+
+    spool_size = 0
+    spool_directory = None
+
+    def read(self, size):
+        if not self.spool_size or not self.spool_directory or size < self.spool_size:
+            return super().read(size)
+        path = create_spool_path(self.spool_directory)
+        with open(path, 'wb') as fp:
+            remaining = size
+            while remaining:
+                chunk = super().read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise self.abort('connection closed while reading a literal')
+                fp.write(chunk)
+                remaining -= len(chunk)
+        return SpooledLiteral(path, size)
+
+
+class SpoolingIMAP4(IdleMixin, DeflateMixin, SpoolingMixin, imaplib.IMAP4):
+    pass
+
+
+class SpoolingIMAP4_SSL(IdleMixin, DeflateMixin, SpoolingMixin, imaplib.IMAP4_SSL):
+    pass
+
+
+class LineReader:
+    """Lines of a file, split every CHUNK_SIZE bytes, with a push back"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pushed = []
+        self.line_start = True
+
+    def next(self):
+        """Return (line, starts_a_line) or (None, True) at the end"""
+        if self.pushed:
+            return self.pushed.pop()
+        line = self.fp.readline(CHUNK_SIZE)
+        if not line:
+            return None, True
+        starts_a_line = self.line_start
+        self.line_start = line.endswith(b'\n')
+        return line, starts_a_line
+
+    def push(self, item):
+        self.pushed.append(item)
+
+
+def match_boundary(line, boundaries):
+    """Return (index, closing) of the boundary delimited by line, or None"""
+    if not line.startswith(b'--'):
+        return None
+    stripped = line.rstrip()
+    for index in range(len(boundaries) - 1, -1, -1):
+        delimiter = b'--' + boundaries[index]
+        if stripped == delimiter:
+            return index, False
+        if stripped == delimiter + b'--':
+            return index, True
+    return None
+
+
+def split_message(fp, spool_directory):
+    """Copy a message from fp, moving the large attachment bodies to files in spool_directory
+
+    Each moved body is replaced by an empty body and a X-Imapbox-Spool header with the
+    path of its file, so the rest of the message can be parsed in memory.
+    """
+    out = []
+    split_entity(LineReader(fp), out, [], spool_directory)
+    return b''.join(out)
+
+
+def split_entity(lines, out, boundaries, spool_directory):
+    header_lines = []
+    while True:
+        line, line_start = lines.next()
+        if line is None:
+            out.extend(header_lines)
+            return
+        if line_start and match_boundary(line, boundaries):
+            # part without header
+            lines.push((line, line_start))
+            out.extend(header_lines)
+            return
+        header_lines.append(line)
+        if line_start and line in (b'\r\n', b'\n'):
+            break
+
+    headers = email.parser.BytesHeaderParser().parsebytes(b''.join(header_lines))
+    out.extend(header_lines[:-1])
+    header_end = len(out)
+    out.append(header_lines[-1])
+
+    if headers.get_content_maintype() == 'multipart' and headers.get_boundary():
+        split_multipart(lines, out, boundaries, spool_directory, headers.get_boundary().encode('ascii', 'replace'))
+    elif headers.get_content_type() == 'message/rfc822':
+        split_entity(lines, out, boundaries, spool_directory)
+    else:
+        spoolable = headers.get_filename() or headers.get_content_maintype() != 'text'
+        split_body(lines, out, boundaries, spool_directory, header_end, line_ending(header_lines[-1]) if spoolable else None)
+
+
+def split_multipart(lines, out, boundaries, spool_directory, boundary):
+    boundaries.append(boundary)
+    level = len(boundaries) - 1
+    while True:
+        line, line_start = lines.next()
+        if line is None:
+            break
+        found = match_boundary(line, boundaries) if line_start else None
+        if found is None:
+            # preamble
+            out.append(line)
+            continue
+        index, closing = found
+        if index != level:
+            # missing closing boundary
+            lines.push((line, line_start))
+            break
+        out.append(line)
+        if closing:
+            boundaries.pop()
+            copy_epilogue(lines, out, boundaries)
+            return
+        split_entity(lines, out, boundaries, spool_directory)
+    boundaries.pop()
+
+
+def copy_epilogue(lines, out, boundaries):
+    while True:
+        line, line_start = lines.next()
+        if line is None:
+            return
+        if line_start and match_boundary(line, boundaries):
+            lines.push((line, line_start))
+            return
+        out.append(line)
+
+
+def split_body(lines, out, boundaries, spool_directory, header_end, eol):
+    body = []
+    size = 0
+    spool = None
+    pending_eol = b''
+    while True:
+        line, line_start = lines.next()
+        if line is None:
+            break
+        if line_start and match_boundary(line, boundaries):
+            lines.push((line, line_start))
+            break
+        if spool is not None:
+            # the line ending before a boundary belongs to the boundary
+            content = line.rstrip(b'\r\n')
+            spool.write(pending_eol + content)
+            pending_eol = line[len(content):]
+            continue
+        body.append(line)
+        size += len(line)
+        if eol is not None and size > PART_SPOOL_SIZE:
+            fd, path = tempfile.mkstemp(dir=spool_directory, suffix='.part')
+            spool = os.fdopen(fd, 'wb')
+            data = b''.join(body)
+            content = data.rstrip(b'\r\n')
+            spool.write(content)
+            pending_eol = data[len(content):]
+            body = []
+
+    if spool is None:
+        out.extend(body)
+        return
+    spool.close()
+    out.insert(header_end, ('%s: %s' % (SPOOL_HEADER, path)).encode('utf8') + eol)
+    # keep the line ending before the next boundary
+    out.append(pending_eol)
+
+
+def line_ending(line):
+    return b'\r\n' if line.endswith(b'\r\n') else b'\n'
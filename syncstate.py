@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+
+
+class SyncState:
+    """Persistent UIDVALIDITY, last exported UID and STATUS per account and folder"""
+
+    def __init__(self, local_folder):
+        self.file = os.path.join(local_folder, '.imapbox', 'syncstate.json')
+        self.lock = threading.Lock()
+        self.state = self.load()
+
+    def load(self):
+        if not os.path.exists(self.file):
+            return {}
+        try:
+            with open(self.file, 'r', encoding='utf8') as fp:
+                return json.load(fp)
+        except Exception as e:
+            print("SyncState: Couldn't read '%s', starting a full resync" % self.file)
+            print(e)
+            return {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as fp:
+            json.dump(self.state, fp, indent=4)
+        os.replace(tmp_file, self.file)
+
+    def get(self, account_name, folder):
+        """Return (uidvalidity, last_uid) or (None, 0) if the folder was never synced"""
+        with self.lock:
+            entry = self.state.get(account_name, {}).get(folder)
+        if not entry:
+            return None, 0
+        return entry['uidvalidity'], entry['last_uid']
+
+    def get_status(self, account_name, folder):
+        """Return the STATUS of the folder before its last complete export, or None"""
+        with self.lock:
+            entry = self.state.get(account_name, {}).get(folder)
+        return entry.get('status') if entry else None
+
+    def get_failures(self, account_name, folder):
+        """Return {uid: failed attempts} of the messages after last_uid that could not be archived"""
+        with self.lock:
+            entry = self.state.get(account_name, {}).get(folder)
+        return {int(uid): attempts for uid, attempts in entry.get('failures', {}).items()} if entry else {}
+
+    def set(self, account_name, folder, uidvalidity, last_uid, status=None, failures=None):
+        """Record the state of a folder, failures {uid: attempts} kept from the last state if None"""
+        with self.lock:
+            folders = self.state.setdefault(account_name, {})
+            if failures is None:
+                failures = (folders.get(folder) or {}).get('failures', {})
+            folders[folder] = {
+                'uidvalidity': uidvalidity,
+                'last_uid': last_uid,
+                'status': status,
+                'failures': {str(uid): attempts for uid, attempts in failures.items()},
+            }
+            self.save()
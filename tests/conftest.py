@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import email.utils
+import os
+import sys
+from email.message import EmailMessage
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+from imapstandin import StandInMailbox, StandInServer  # noqa: E402
+from mailboxclient import Exporter  # noqa: E402
+
+
+def make_message(number, attachment=None):
+    """Raw bytes of a text and HTML message, with an attachment of these bytes if given"""
+    message = EmailMessage()
+    message['From'] = 'sender{}@example.com'.format(number)
+    message['To'] = 'archive@example.com'
+    message['Subject'] = 'Message {}'.format(number)
+    message['Date'] = email.utils.format_datetime(datetime.datetime(2024, 1, 1 + number % 28, 12, number % 60, tzinfo=datetime.timezone.utc))
+    message['Message-Id'] = '<message{}@example.com>'.format(number)
+    message.set_content('Text of message {}\n'.format(number))
+    message.add_alternative('<p>HTML of message {}</p>\n'.format(number), subtype='html')
+    if attachment is not None:
+        message.add_attachment(attachment, maintype='application', subtype='octet-stream', filename='data.bin')
+    return message.as_bytes()
+
+
+@pytest.fixture
+def server():
+    """Start a stand-in IMAP server of {folder: [raw message]}, return its port"""
+    servers = []
+
+    def start(folders):
+        mailboxes = {}
+        for folder, messages in folders.items():
+            mailboxes[folder] = StandInMailbox(folder)
+            for raw in messages:
+                mailboxes[folder].append(raw)
+        servers.append(StandInServer(mailboxes))
+        return servers[-1].start()
+
+    yield start
+    for started in servers:
+        started.shutdown()
+        started.server_close()
+
+
+@pytest.fixture
+def export(tmp_path, monkeypatch):
+    """Run imapbox against the stand-in server on port, with these options, return the archive folder"""
+    for name in list(os.environ):
+        if name.startswith('IMAPBOX_'):
+            monkeypatch.delenv(name)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    local_folder = str(tmp_path / 'archive')
+    os.makedirs(local_folder, exist_ok=True)
+    monkeypatch.setenv('IMAPBOX_LOCAL_FOLDER', local_folder)
+
+    def run(port, *args, **options):
+        benchmark.write_config(local_folder, port, {name: str(value) for name, value in options.items()})
+        monkeypatch.setattr(sys, 'argv', ['imapbox.py', '-l', local_folder, '-a', 'benchmark'] + list(args))
+        Exporter().run()
+        return local_folder
+
+    return run
+
+
+def archived(local_folder):
+    """{path: bytes} of the files of the archive, without its state"""
+    files = {}
+    for root, dirs, names in os.walk(local_folder):
+        dirs[:] = [d for d in dirs if d != '.imapbox']
+        for name in names:
+            if name != 'config.cfg':
+                path = os.path.join(root, name)
+                with open(path, 'rb') as fp:
+                    files[os.path.relpath(path, local_folder)] = fp.read()
+    return files
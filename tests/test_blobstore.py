@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from blobstore import BlobStore
+
+
+def test_link_keeps_the_last_content(tmp_path):
+    blob_store = BlobStore(str(tmp_path / 'blobs'))
+    target = str(tmp_path / 'attachments' / 'data.bin')
+    blob_store.blob(b'first').save(target)
+    blob_store.blob(b'second').save(target)
+    with open(target, 'rb') as fp:
+        assert fp.read() == b'second'
+    blob_store.blob(b'second').save(target)
+    assert os.listdir(str(tmp_path / 'attachments')) == ['data.bin']
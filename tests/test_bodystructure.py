@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from bodystructure import OMITTED_HEADER, PARTIAL_HEADER, parse_bodystructure_response
+
+RESPONSE = [
+    b'1 (UID 7 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 12 1 NIL NIL NIL NIL)'
+    b'("application" "pdf" ("name" "report.pdf") NIL NIL "base64" 50000 NIL ("attachment" ("filename" "report.pdf")) NIL NIL)'
+    b' "mixed" ("boundary" "b1") NIL NIL NIL))',
+    b'2 (UID 8 BODYSTRUCTURE ("text" "plain" ("charset" "us-ascii") NIL NIL "7bit" 5 1 NIL NIL NIL NIL))',
+]
+
+
+def test_parse_bodystructure_response():
+    structures = parse_bodystructure_response(RESPONSE)
+    assert sorted(structures) == [7, 8]
+    mixed = structures[7]
+    assert mixed.content_type == 'multipart/mixed'
+    assert [(part.section, part.content_type, part.size, part.filename) for part in mixed.children] == [
+        ('1', 'text/plain', 12, None), ('2', 'application/pdf', 50000, 'report.pdf')]
+    assert [part.section for part in mixed.omitted(10000)] == ['2']
+    assert mixed.fetch_items(10000) == ['BODY.PEEK[HEADER]', 'BODY.PEEK[1.MIME]', 'BODY.PEEK[1]', 'BODY.PEEK[2.MIME]']
+    assert structures[8].content_type == 'text/plain'
+    assert structures[8].omitted(1) == []
+
+
+def test_assemble_marks_the_omitted_parts():
+    mixed = parse_bodystructure_response(RESPONSE)[7]
+    raw = mixed.assemble({
+        'HEADER': b'Subject: report\r\nContent-Type: multipart/mixed; boundary="b1"\r\n\r\n',
+        'BODY[1.MIME]': b'Content-Type: text/plain; charset=utf-8\r\n\r\n',
+        'BODY[1]': b'see attached',
+        'BODY[2.MIME]': b'Content-Type: application/pdf; name="report.pdf"\r\n\r\n',
+    }, 10000)
+    assert '{}: yes'.format(PARTIAL_HEADER).encode() in raw
+    assert '{}: size=50000; section=2'.format(OMITTED_HEADER).encode() in raw
+    assert b'see attached' in raw
+    assert raw.rstrip().endswith(b'--b1--')
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from conftest import archived, make_message
+
+ENGINES = {
+    'threads': {},
+    'processes': {'processes': 1},
+    'asyncio': {'engine': 'asyncio'},
+}
+
+
+@pytest.mark.parametrize('options', list(ENGINES.values()), ids=list(ENGINES))
+def test_round_trip(server, export, options):
+    attachment = bytes(range(256)) * 64
+    inbox = [make_message(1), make_message(2, attachment)]
+    folder1 = [make_message(3)]
+    port = server({'INBOX': inbox, 'Folder1': folder1})
+    local_folder = export(port, **options)
+
+    files = archived(local_folder)
+    messages = {os.path.dirname(path): content for path, content in files.items() if os.path.basename(path) == 'message.eml'}
+    assert sorted(messages.values()) == sorted(inbox + folder1)
+    assert sorted(directory.split(os.sep)[0] for directory in messages) == ['Folder1', 'INBOX', 'INBOX']
+    for directory in messages:
+        for name in ('message.html', 'message.txt', 'message.json'):
+            assert os.path.join(directory, name) in files
+    attachments = [content for path, content in files.items() if path.endswith(os.path.join('attachments', 'data.bin'))]
+    assert attachments == [attachment]
+
+    # nothing new on the server, nothing changes
+    export(port, **options)
+    assert archived(local_folder) == files
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sqlite3
+
+from conftest import make_message
+from mailboxclient import parse_fetch_response, parse_status_response
+from messageindex import MessageIndex
+
+
+def test_index_error_is_retried(server, export, monkeypatch):
+    port = server({'INBOX': [make_message(1), make_message(2), make_message(3)]})
+    get = MessageIndex.get
+
+    def locked(self, message_id, within=None):
+        if message_id == '<message2@example.com>':
+            raise sqlite3.OperationalError('database is locked')
+        return get(self, message_id, within)
+
+    monkeypatch.setattr(MessageIndex, 'get', locked)
+    local_folder = export(port)
+    with open(os.path.join(local_folder, '.imapbox', 'syncstate.json'), encoding='utf8') as fp:
+        state = json.load(fp)['benchmark']['INBOX']
+    # not skipped for good, fetched again by the next run
+    assert state['last_uid'] == 1
+    assert state['failures'] == {'2': 1}
+
+    monkeypatch.setattr(MessageIndex, 'get', get)
+    export(port)
+    with open(os.path.join(local_folder, '.imapbox', 'syncstate.json'), encoding='utf8') as fp:
+        state = json.load(fp)['benchmark']['INBOX']
+    assert state['last_uid'] == 3
+    assert state['failures'] == {}
+    assert MessageIndex(local_folder).get('<message2@example.com>') is not None
+
+
+def test_parse_fetch_response():
+    data = [
+        (b'1 (UID 5 RFC822.SIZE 1234 INTERNALDATE "01-Jan-2024 10:00:00 +0000" BODY[HEADER.FIELDS (DATE FROM MESSAGE-ID)] {22}',
+         b'Message-Id: <a@b.c>\r\n\r\n'),
+        b')',
+        (b'2 (UID 6 BODY[] {5}', b'hello'),
+        b')',
+        b'3 (FLAGS (\\Seen))',
+    ]
+    assert parse_fetch_response(data) == [
+        {'UID': 5, 'RFC822.SIZE': 1234, 'INTERNALDATE': '01-Jan-2024 10:00:00 +0000', 'HEADER': b'Message-Id: <a@b.c>\r\n\r\n'},
+        {'UID': 6, 'RFC822': b'hello'},
+    ]
+
+
+def test_parse_status_response():
+    assert parse_status_response(b'"INBOX" (MESSAGES 3 UIDNEXT 10 UIDVALIDITY 7 HIGHESTMODSEQ 42)') == {
+        'MESSAGES': 3, 'UIDNEXT': 10, 'UIDVALIDITY': 7, 'HIGHESTMODSEQ': 42}
+    assert parse_status_response(None) is None
+    assert parse_status_response(b'garbage') is None
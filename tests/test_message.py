@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from email.message import EmailMessage
+
+from message import Message, extract_html_body
+
+
+def test_extract_html_body():
+    assert extract_html_body('<html><head></head><body class="x">Hello</body></html>') == 'Hello'
+    # the last </body>, a quoted message may contain its own
+    assert extract_html_body('<body>a<body>b</body>c</body>') == 'a<body>b</body>c'
+    assert extract_html_body('<p>no body element</p>') == '<p>no body element</p>'
+    assert extract_html_body('<body>never closed') == '<body>never closed'
+
+
+def test_replace_cid_links(tmp_path):
+    message = EmailMessage()
+    message['From'] = 'sender@example.com'
+    message['Subject'] = 'Logo'
+    message['Date'] = 'Mon, 01 Jan 2024 10:00:00 +0000'
+    message.set_content('Logo')
+    message.add_alternative('<p><img src="cid:LOGO@example"> <img src=\'cid:unknown\'></p>', subtype='html')
+    message.get_payload()[1].add_related(b'\x89PNG', maintype='image', subtype='png', cid='<logo@example>', filename='logo.png')
+
+    files = []
+    rendered = Message(message.as_bytes(), str(tmp_path), files)
+    rendered.create_files()
+    html = dict(files)['message.html'].decode('utf8')
+    assert 'src="attachments/logo.png"' in html
+    # the Content-Ids without a part are left alone
+    assert "src='cid:unknown'" in html
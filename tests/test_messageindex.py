@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+
+from conftest import make_message
+from messageindex import MessageIndex
+
+
+def test_copy_per_local_subfolder(server, export):
+    raw = make_message(1)
+    port = server({'INBOX': [raw], 'Folder1': [raw]})
+    local_folder = export(port)
+    index = MessageIndex(local_folder)
+    inbox = index.get('<message1@example.com>', os.path.join(local_folder, 'INBOX'))
+    folder1 = index.get('<message1@example.com>', os.path.join(local_folder, 'Folder1'))
+    assert inbox is not None and os.path.relpath(inbox, local_folder).startswith('INBOX' + os.sep)
+    assert folder1 is not None and os.path.relpath(folder1, local_folder).startswith('Folder1' + os.sep)
+    assert index.get_source('<message1@example.com>', os.path.join(local_folder, 'Folder1')) == 'benchmark/Folder1'
+    index.close()
+
+
+def test_index_without_roots_is_replaced(tmp_path):
+    os.makedirs(str(tmp_path / '.imapbox'))
+    connection = sqlite3.connect(str(tmp_path / '.imapbox' / 'index.sqlite'))
+    connection.execute('CREATE TABLE messages (message_id TEXT PRIMARY KEY, directory TEXT NOT NULL, source TEXT)')
+    connection.execute("INSERT INTO messages VALUES ('<a@example.com>', 'INBOX/2024/a', NULL)")
+    connection.commit()
+    connection.close()
+    index = MessageIndex(str(tmp_path))
+    assert index.get('<a@example.com>') is None
+    index.add('<a@example.com>', str(tmp_path), str(tmp_path / '2024' / 'a'))
+    assert index.get('<a@example.com>', str(tmp_path)) == str(tmp_path / '2024' / 'a')
+    assert index.get('<a@example.com>', str(tmp_path / 'INBOX')) is None
+    index.close()
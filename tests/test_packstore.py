@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from blobstore import BlobStore
+from packstore import PackStore
+
+
+class FailingContent:
+    def write_to(self, fp):
+        fp.write(b'partial content')
+        raise OSError('No space left on device')
+
+
+def test_failed_add_leaves_nothing(tmp_path):
+    pack_store = PackStore(str(tmp_path))
+    assert pack_store.add(os.path.join(str(tmp_path), 'a'), [('message.eml', b'first')])
+    with pytest.raises(OSError):
+        pack_store.add(os.path.join(str(tmp_path), 'b'), [('message.eml', b'second'), ('message.html', FailingContent())])
+    assert not pack_store.contains(os.path.join(str(tmp_path), 'b'))
+    assert pack_store.add(os.path.join(str(tmp_path), 'b'), [('message.eml', b'second')])
+    pack_store.close()
+
+    pack_store = PackStore(str(tmp_path))
+    assert pack_store.reindex() == 2
+    assert pack_store.read_file('a', 'message.eml') == b'first'
+    assert pack_store.read_file('b', 'message.eml') == b'second'
+    pack_store.close()
+
+
+def test_extract_lists_skipped_blobs(tmp_path, capsys):
+    blob_store = BlobStore(str(tmp_path / 'blobs'))
+    pack_store = PackStore(str(tmp_path))
+    pack_store.add(os.path.join(str(tmp_path), 'a'), [('message.eml', b'message'), ('attachments/data.bin', blob_store.blob(b'data'))])
+    pack_store.sync()
+
+    assert pack_store.extract(str(tmp_path / 'linked'), blob_store=blob_store) == 1
+    with open(str(tmp_path / 'linked' / 'a' / 'attachments' / 'data.bin'), 'rb') as fp:
+        assert fp.read() == b'data'
+
+    assert pack_store.extract(str(tmp_path / 'without'), blob_store=None) == 1
+    assert os.path.join('a', 'attachments', 'data.bin') in capsys.readouterr().out
+    assert not os.path.exists(str(tmp_path / 'without' / 'a' / 'attachments'))
+    pack_store.close()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import os
+import types
+from email.message import EmailMessage
+
+from conftest import make_message
+from rebuild import Rebuilder
+
+
+def make_attachment_only():
+    message = EmailMessage()
+    message['From'] = 'scanner@example.com'
+    message['Subject'] = 'Scan'
+    message['Date'] = 'Mon, 01 Jan 2024 10:00:00 +0000'
+    message['Message-Id'] = '<scan@example.com>'
+    message.set_content(b'%PDF-1.4 scan', maintype='application', subtype='pdf', filename='scan.pdf')
+    return message.as_bytes()
+
+
+def test_message_without_body_is_up_to_date(server, export):
+    port = server({'INBOX': [make_message(1), make_attachment_only()]})
+    local_folder = export(port)
+    rebuilder = Rebuilder(types.SimpleNamespace(local_folder=local_folder, json=True, wkhtmltopdf=None))
+    directories = list(rebuilder.walk())
+    assert len(directories) == 2
+    assert not any(os.path.exists(os.path.join(directory, 'message.html')) for directory in directories if 'scanner' in directory)
+    assert [directory for directory in directories if rebuilder.is_stale(directory)] == []
+
+    with_text = [directory for directory in directories if 'sender1' in directory][0]
+    os.remove(os.path.join(with_text, 'message.html'))
+    assert rebuilder.is_stale(with_text)